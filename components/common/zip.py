@@ -58,6 +58,54 @@ def unzip_trajectories(filename):
         return result
 
 
+def pack_contours(contours):
+    """
+    Concatenate contours of all frames into one array of points, sizes of the contours are returned along with it
+    """
+    sizes = np.asarray([len(points) for points in contours], dtype=np.int32)
+    if len(contours) == 0:
+        return np.zeros((0, 2)), sizes
+    return np.concatenate([np.asarray(points, dtype=np.float64).reshape(-1, 2) for points in contours]), sizes
+
+
+def unpack_contours(points, sizes):
+    """
+    Split concatenated points into contours of the given sizes
+    """
+    return np.split(points, np.cumsum(sizes)[:-1]) if len(sizes) > 0 else []
+
+
+class NpzWriter(object):
+    """
+    Write arrays one by one to a single NPZ archive, the archive is readable by `np.load` (lazily, by name)
+    once the writer is closed. Names may contain '/' to group arrays, e.g. '<filament>/contours'.
+    """
+
+    def __init__(self, filename):
+        self.zipfile = ZipFile(filename, 'w', allowZip64=True)
+
+    def write(self, name, array):
+        string_buffer = StringIO()
+        np.lib.format.write_array(string_buffer, np.asanyarray(array), allow_pickle=False)
+        self.zipfile.writestr(name + '.npy', string_buffer.getvalue())
+
+    def close(self):
+        self.zipfile.close()
+
+
+def unzip_results(filename):
+    """
+    Read contours of all filaments from a result store written with NpzWriter: name -> list of contours
+    """
+    result = dict()
+    with np.load(filename) as store:
+        for key in store.files:
+            name, _, field = key.rpartition('/')
+            if field == 'contours':
+                result[name] = unpack_contours(store[key], store[name + '/sizes'])
+    return result
+
+
 def to_csv(filename, matrix):
     try:
         with open(filename, "w") as fout:
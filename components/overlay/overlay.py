@@ -20,7 +20,7 @@ import matplotlib as mpl
 mpl.use('TkAgg')
 
 # Import individual functions and classes
-from zip import unzip_csv, colors_from_csv
+from zip import unzip_csv, unzip_results, colors_from_csv
 from config import Config
 from input import get_latest_folder
 from draw.legend import gen_legend, get_random_colors
@@ -51,12 +51,17 @@ def main():
 
     print "Input folder:", input_folder
 
-    # Read trajectories
-    filenames = filter(lambda fn: fn.lower().endswith(".zip"), os.listdir(input_folder))
-    labels = map(lambda fn: os.path.splitext(fn)[0], filenames)
+    # Read trajectories from the result store or from per-filament ZIPs
+    store_path = os.path.join(input_folder, "tracks.npz")
+    if os.path.exists(store_path):
+        contours = unzip_results(store_path)
+        labels = contours.keys()
+    else:
+        filenames = filter(lambda fn: fn.lower().endswith(".zip"), os.listdir(input_folder))
+        labels = map(lambda fn: os.path.splitext(fn)[0], filenames)
 
-    # Upload trajectories
-    contours = {label : unzip_csv(os.path.join(input_folder, filename)) for filename, label in zip(filenames, labels)}
+        # Upload trajectories
+        contours = {label : unzip_csv(os.path.join(input_folder, filename)) for filename, label in zip(filenames, labels)}
     contours_n = len(contours)
 
     # Read image sequence
@@ -11,6 +11,7 @@
 
 import os
 import sys
+import cv2
 import numpy as np
 
 # Add common scripts
@@ -73,3 +74,40 @@ def transform_binary(image):
 
 def transform_distance(image):
     return medial_axis(image == 0, return_distance=True)[1].astype(np.double)
+
+
+def decode_gvf(gvf_magnitude, gvf_angle):
+    """
+    Decode GVF stored by the preprocessor as uint8 magnitude and angle images to float32 x and y components
+    (the same way as vfsampler decodes sampled values). Frames are decoded one by one to limit temporary memory.
+    """
+    gvf_x = np.empty(gvf_magnitude.shape, dtype=np.float32)
+    gvf_y = np.empty(gvf_magnitude.shape, dtype=np.float32)
+    for i in xrange(len(gvf_magnitude)):
+        magnitude = gvf_magnitude[i] / 255.0
+        angle = (2.0 * gvf_angle[i] / 255.0 - 1.0) * np.pi
+        gvf_x[i] = magnitude * np.cos(angle)
+        gvf_y[i] = magnitude * np.sin(angle)
+    return gvf_x, gvf_y
+
+
+def gvf_pyramid(gvf_magnitude, gvf_angle, levels):
+    """
+    Coarse levels 1, ..., `levels` - 1 of the Gaussian pyramid of the GVF stored by the preprocessor (decoded to
+    float32 x and y components, see `decode_gvf`). Every level is reduced by cv2.pyrDown, so that pixel i of the level
+    l is centered at pixel 2^l * i of the 2x upscaled GVF. Returns layers 'gvf_x_<l>' and 'gvf_y_<l>'.
+    """
+    layers = {level: ([], []) for level in xrange(1, levels)}
+    for i in xrange(len(gvf_magnitude)):
+        gvf_x, gvf_y = decode_gvf(gvf_magnitude[i:i+1], gvf_angle[i:i+1])
+        gvf_x, gvf_y = gvf_x[0], gvf_y[0]
+        for level in xrange(1, levels):
+            gvf_x, gvf_y = cv2.pyrDown(gvf_x), cv2.pyrDown(gvf_y)
+            layers[level][0].append(gvf_x)
+            layers[level][1].append(gvf_y)
+
+    result = dict()
+    for level, (gvf_x, gvf_y) in layers.items():
+        result['gvf_x_{0}'.format(level)] = np.asarray(gvf_x, dtype=np.float32)
+        result['gvf_y_{0}'.format(level)] = np.asarray(gvf_y, dtype=np.float32)
+    return result
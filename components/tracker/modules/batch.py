@@ -0,0 +1,135 @@
+#
+# Copyright (C) Software Competence Center Hagenberg GmbH (SCCH)
+# All rights reserved.
+#
+# This document contains proprietary information belonging to SCCH.
+# Passing on and copying of this document, use and communication of its
+# contents is not permitted without prior written authorization.
+#
+
+import numpy as np
+from timeit import default_timer
+
+from snakes import get_snake_solver
+from track import Tracker, start_recording, finish_recording
+from timing import timed
+from vfsampler.vfsampler import evolve_snakes as native_evolve_snakes
+
+
+class BatchTracker(Tracker):
+    """
+    Tracks several filaments together. On every frame the snakes of all filaments are evolved together by the native
+    kernel: one GVF sampling of all snakes per iteration, converged snakes are frozen. Endpoints of all filaments
+    are tracked in one pass.
+    """
+
+    def track_batch(self, initial_positions, log):
+        """
+        Track filaments with `initial_positions` (list of snakes or final states of a previous run),
+        returns list of results (see `Tracker.track`), None for filaments whose endpoints are lost
+        """
+        # Get image sequence shape
+        frame_n = self.image_sequence.enhanced.shape[0]
+        log += "  [BatchTracker] : number of images: " + str(frame_n)
+
+        # Initialize tracking states
+        states = [self.start(points) for points in initial_positions]
+        lost = []
+
+        for image_i in xrange(min(state.first_frame for state in states), frame_n):
+
+            # Print current frame index
+            log += "  [BatchTracker] : current frame: " + str(image_i)
+
+            # Filaments continued from a previous run start later, filaments with lost endpoints are not tracked
+            active = [state for state in states if state.first_frame <= image_i and state not in lost]
+            if len(active) > 0:
+                lost.extend(self.track_frame_batch(active, image_i))
+
+        return [state.result() if state not in lost else None for state in states]
+
+    def track_frame_batch(self, states, image_i, warm_start=True, track_ends=True):
+        """
+        Evolve snakes of all `states` on frame `image_i` and track their endpoints to the next frame.
+        If `warm_start` is False, the initial snakes are expected to be advected already (see `warm_start`),
+        if `track_ends` is False, the endpoints are tracked later (see `track_next_endpoints`).
+        Returns states whose endpoints are lost on the next frame.
+        """
+        # Advect the initial snakes with optical flow
+        if warm_start:
+            self.warm_start(states, image_i)
+
+        # Generate branching potentials at the endpoints and evolve the snakes on the coarse levels of the GVF pyramid
+        iter_ns = []
+        for state in states:
+            self.prepare_frame(state, image_i)
+            iter_ns.append(self.evolve_coarse(state, image_i))
+
+        # Evolve snakes
+        self.evolve_snakes(states, image_i, iter_ns)
+
+        # Track endpoints of all snakes to the next frame at once
+        for state in states:
+            self.compare_iterations(state, image_i)
+            self.finish_frame(state, image_i, track_ends=False)
+        if track_ends:
+            return self.track_next_endpoints(states, image_i)
+        return []
+
+    def evolve_snakes(self, states, image_i, iter_ns):
+        """
+        Evolve snakes of all `states` on frame `image_i` starting from their initial snakes,
+        `iter_ns` are maximum numbers of iterations of the snakes (see `Tracker.evolve_coarse`).
+        Snakes with the banded solver are evolved together (see `evolve_together`), the others one by one
+        (see `Tracker.evolve_snake`).
+        """
+        banded = [get_snake_solver(state.point_n, self.alpha, self.beta, self.dt).is_banded for state in states]
+        if any(banded):
+            self.evolve_together([state for state, is_banded in zip(states, banded) if is_banded], image_i,
+                                 [iter_n for iter_n, is_banded in zip(iter_ns, banded) if is_banded])
+
+        enhanced_image = self.image_sequence.enhanced[image_i]
+        gvf = self.gvf_field(image_i)
+
+        for state, iter_n, is_banded in zip(states, iter_ns, banded):
+            if is_banded:
+                continue
+            frame_i = image_i - state.first_frame
+            (br_p0, br_f0, br_m0, br_o0), (br_p1, br_f1, br_m1, br_o1) = state.branching
+            self.set_solver(state.point_n)
+            state.snake_contours[frame_i], state.iterations[frame_i] = \
+                self.evolve_snake(state.snake_init, gvf, enhanced_image, br_f0, br_f1, iter_n, self.dt,
+                                  state.point_n, state.trajectory(image_i), state.history(image_i),
+                                  br_offsets=(br_o0, br_o1))
+
+    @timed('evolution')
+    def evolve_together(self, states, image_i, iter_ns):
+        """
+        Evolve snakes of all `states` on frame `image_i` together by the native kernel (see vfsampler.evolve_snakes),
+        every snake the same as by `Tracker.evolve_snake`: a snake is frozen as soon as it converges,
+        the others continue until they converge or make their maximum numbers of iterations `iter_ns`
+        """
+        enhanced_image = self.image_sequence.enhanced[image_i]
+        gvf = self.gvf_field(image_i)
+
+        snakes = [np.array(state.snake_init, dtype=np.double) for state in states]
+        trajectories = [state.trajectory(image_i) for state in states]
+        for trajectory, snake in zip(trajectories, snakes):
+            start_recording(trajectory, snake)
+
+        self.stage_times.fill(0.0)
+        start = default_timer()
+        iterations = native_evolve_snakes(
+            snakes, gvf, enhanced_image, [(state.branching[0][1], state.branching[1][1]) for state in states],
+            [(state.branching[0][3], state.branching[1][3]) for state in states],
+            [get_snake_solver(state.point_n, self.alpha, self.beta, self.dt).factor for state in states],
+            self.dt, iter_ns, self.motion_threshold,
+            trajectories=[None if trajectory is None else trajectory[:iter_n + 1]
+                          for trajectory, iter_n in zip(trajectories, iter_ns)],
+            histories=[state.history(image_i) for state in states], stage_times=self.stage_times)
+        self.profile.add_native(self.stage_times, iterations.sum(), default_timer() - start)
+
+        for state, snake, iter_i in zip(states, snakes, iterations):
+            frame_i = image_i - state.first_frame
+            state.snake_contours[frame_i], state.iterations[frame_i] = snake, iter_i
+            finish_recording(state.trajectory(image_i), state.history(image_i), iter_i, snake)
@@ -13,42 +13,53 @@ import math
 import networkx as nx
 import numpy as np
 from scipy import interpolate
+from vfsampler.vfsampler import reparametrize_contour
 
 
 def get_graph_position(g):
     return {node_id: data["pos"] for node_id, data in g.nodes_iter(data=True)}
 
 
+# Orders of the spline kinds of scipy.interpolate.interp1d
+_spline_orders = {"slinear": 1, "quadratic": 2, "cubic": 3}
+
+
 def uniform_contour_reparametrization(x, y, step=1.0, curve_kind="cubic"):
     """
     Input: x, y - ndarrays for x and y coordinates of polyline, step is desired approximate step. 
     For curve_kind see kind parameter of scipy.interpolate.interp1d
     Returns new_x, new_y, new_step
     """
+    points = np.ascontiguousarray(np.column_stack([x, y]), dtype=np.double)
     l = np.hstack([[0.0], np.cumsum(np.sqrt((x[1:] - x[:-1]) ** 2 + (y[1:] - y[:-1]) ** 2))]).ravel()
-    # 
-    fx = interpolate.interp1d(l, x, kind=curve_kind)
-    fy = interpolate.interp1d(l, y, kind=curve_kind)
     #
     length = l[-1]
     point_n = int(length / step)
     
     new_step = length / point_n
-    reparam_t = np.linspace(0.0, length, point_n)
-    
-    return fx(reparam_t), fy(reparam_t), new_step
+
+    if curve_kind == "linear":
+        new_points, _ = reparametrize_contour(points, point_n)
+    elif curve_kind in _spline_orders:
+        # the same spline as interp1d builds, but one for both coordinates and without validation of the input
+        spline = interpolate.make_interp_spline(l, points, k=_spline_orders[curve_kind], check_finite=False)
+        new_points = spline(np.linspace(0.0, length, point_n))
+    else:
+        new_points = interpolate.interp1d(l, points, kind=curve_kind, axis=0, assume_sorted=True)(
+            np.linspace(0.0, length, point_n))
+
+    return new_points[:, 0], new_points[:, 1], new_step
 
 
 def uniform_contour_reparametrization_n(x, y, point_n):
-    l = np.hstack([[0.0], np.cumsum(np.sqrt((x[1:] - x[:-1]) ** 2 + (y[1:] - y[:-1]) ** 2))]).ravel()
-    # 
-    fx = interpolate.interp1d(l, x, kind="linear")
-    fy = interpolate.interp1d(l, y, kind="linear")
-    #
-    length = l[-1]
-    reparam_t = np.linspace(0.0, length, point_n)
-    
-    return fx(reparam_t), fy(reparam_t), reparam_t[1]
+    """
+    Linear reparametrization of polyline x, y by `point_n` points uniformly distributed by arc length.
+    Use `reparametrize_contour` with preallocated buffers to avoid allocations in loops.
+    Returns new_x, new_y, new_step
+    """
+    points = np.ascontiguousarray(np.column_stack([x, y]), dtype=np.double)
+    new_points, new_step = reparametrize_contour(points, point_n)
+    return new_points[:, 0], new_points[:, 1], new_step
 
 
 def next_contour_node(graph, prev_node_id, curr_node_id):
@@ -13,7 +13,9 @@ import numpy as np
 import cv2
 import gvf
 
-from vfsampler.vfsampler import sample_vf
+from scipy.linalg import cholesky_banded, lu_factor, lu_solve, LinAlgError
+from scipy.linalg.lapack import dpbtrs
+from vfsampler.vfsampler import sample_vf, decode_vf, sample_sf as native_sample_sf
 
 
 def generate_matrix(N, alpha, beta, is_open=True):
@@ -33,13 +35,81 @@ def generate_matrix(N, alpha, beta, is_open=True):
     return -alpha * A1 + beta * A2
 
 
+class SnakeSolver(object):
+    """
+    Solver of the linear system (I - dt * A) x = b of the snake evolution, where A is the matrix of `generate_matrix`.
+    The matrix of an open snake is pentadiagonal and symmetric positive definite, so it is factorized once in the
+    banded Cholesky form and every solve is linear in N. Closed snakes (cyclic matrix) use the dense LU factorization.
+    """
+
+    def __init__(self, N, alpha, beta, dt, is_open=True):
+        M = np.eye(N, N) - dt * generate_matrix(N, alpha, beta, is_open)
+        self.point_n = N
+        self.is_banded = False
+        if is_open:
+            # upper bands of the symmetric matrix
+            bands_n = min(2, N - 1)
+            M_banded = np.zeros((bands_n + 1, N), dtype=np.double)
+            for k in xrange(bands_n + 1):
+                M_banded[bands_n - k, k:] = np.diagonal(M, k)
+            try:
+                self.factor = cholesky_banded(M_banded)
+                self.is_banded = True
+            except LinAlgError:
+                pass
+        if not self.is_banded:
+            self.factor = lu_factor(M)
+
+    def solve(self, b):
+        """
+        Solve system for the right-hand side `b` of shape (N,) or (N, K)
+        """
+        if self.is_banded:
+            # call LAPACK directly, the overhead of the scipy wrapper is comparable to the solve itself
+            return dpbtrs(self.factor, b, lower=0)[0]
+        return lu_solve(self.factor, b, check_finite=False)
+
+
+_snake_solvers = dict()
+
+
+def get_snake_solver(N, alpha, beta, dt, is_open=True):
+    """
+    Returns SnakeSolver for given parameters, factorizations are cached for the whole process.
+    """
+    key = (N, alpha, beta, dt, is_open)
+    if key not in _snake_solvers:
+        _snake_solvers[key] = SnakeSolver(N, alpha, beta, dt, is_open)
+    return _snake_solvers[key]
+
+
 def bilinear_interp((v00, v01, v10, v11), x, y):
     return (v00 * (1 - x) + v01 * x) * (1 - y) + (v10 * (1 - x) + v11 * x) * y
 
 
-def sample_sf(image, points, interp=True):
+def sample_gvf(gvf, points):
+    """
+    Sample gradient vector flow `gvf` (2x upscaled) at `points`, `gvf` is the pair of uint8 (magnitude, angle)
+    images of the preprocessor or of the decoded float32 (x, y) components
+    """
+    if gvf[0].dtype == np.uint8:
+        return decode_vf(gvf[0], gvf[1], 2.0 * points)
+    return sample_vf(gvf[0], gvf[1], 2.0 * points)
+
+
+def sample_sf(image, points, interp=True, offset=None):
     """
     Sample scalar field (with bilinear interpolation)
+    `offset` is the position (x, y) of `image` if it is a window of a larger image
+    """
+    if offset is not None:
+        points = points - offset
+    return native_sample_sf(image, points, interp)
+
+
+def sample_sf_python(image, points, interp=True):
+    """
+    Sample scalar field (with bilinear interpolation), pure Python version of `sample_sf`
     """
     rows, cols = image.shape
     points_int = points.astype(np.int)
@@ -71,11 +141,12 @@ def get_contour_length(points):
     return np.sum(np.linalg.norm(points[1:] - points[:-1], axis=1))
 
 
-def constraint_forces(stretching_potential, vf_br0, vf_br1, snake_coords, b_mult=100.0):
+def constraint_forces(stretching_potential, vf_br0, vf_br1, snake_coords, b_mult=100.0, br_offsets=None):
     """
     @param stretching_potential is stretching potential
     @param (vf_br0, vf_br1) are vector field of branching potential (for each endpoint)
     @param snake_coords are coordinates of snake
+    @param br_offsets are offsets (x, y) of windows of vf_br0 and vf_br1 (if they don't cover the whole image)
     """
     # initialize constraint forces by zeros
     f = np.zeros_like(snake_coords)
@@ -87,9 +158,11 @@ def constraint_forces(stretching_potential, vf_br0, vf_br1, snake_coords, b_mult
     t1 = d1 / np.linalg.norm(d1)
     # get endpoints of the snake
     endpoints = snake_coords[[0, -1], :]
+    # map endpoints to the windows of branching forces
+    br_endpoints = endpoints if br_offsets is None else endpoints - np.asarray(br_offsets)
     # sample attraction forces from gradients
-    branching_grad0 = sample_vf(vf_br0[0], vf_br0[1], endpoints[0].reshape(1, 2))
-    branching_grad1 = sample_vf(vf_br1[0], vf_br1[1], endpoints[1].reshape(1, 2))
+    branching_grad0 = sample_vf(vf_br0[0], vf_br0[1], br_endpoints[0].reshape(1, 2))
+    branching_grad1 = sample_vf(vf_br1[0], vf_br1[1], br_endpoints[1].reshape(1, 2))
     # stretching forces
     stretching_vals = sample_sf(stretching_potential, endpoints)
     # set constraint forces at the endpoints
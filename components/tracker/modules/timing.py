@@ -0,0 +1,89 @@
+#
+# Copyright (C) Software Competence Center Hagenberg GmbH (SCCH)
+# All rights reserved.
+#
+# This document contains proprietary information belonging to SCCH.
+# Passing on and copying of this document, use and communication of its
+# contents is not permitted without prior written authorization.
+#
+
+import numpy as np
+from functools import wraps
+from timeit import default_timer
+from contextlib import contextmanager
+
+
+# Stages of an iteration of the native evolution in the order of its `stage_times` (see vfsampler.evolve_snake)
+NATIVE_STAGES = ['gvf_sampling', 'constraint_forces', 'linear_solve', 'reparametrization']
+
+
+class StageProfile(object):
+    """
+    Time (in seconds) and number of calls accumulated for every stage of tracking
+    """
+
+    def __init__(self):
+        self.stages = dict()
+
+    def add(self, stage, seconds, calls=1):
+        totals = self.stages.setdefault(stage, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += calls
+
+    @contextmanager
+    def measure(self, stage):
+        """
+        Add the time of the `with` block to `stage`
+        """
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.add(stage, default_timer() - start)
+
+    def add_native(self, stage_times, iteration_n, seconds):
+        """
+        Add stages of the native evolution that made `iteration_n` iterations in `seconds`: the time is split
+        between the stages in proportion to their times on the sampled iterations (see `native_stage_times`)
+        """
+        sampled = stage_times[:len(NATIVE_STAGES)].sum()
+        if sampled > 0:
+            for stage, stage_seconds in zip(NATIVE_STAGES, stage_times):
+                self.add(stage, seconds * stage_seconds / sampled, iteration_n)
+
+    def merge(self, stages):
+        """
+        Add stages of another profile (see `pop`)
+        """
+        for stage, (seconds, calls) in stages.items():
+            self.add(stage, seconds, calls)
+
+    def pop(self):
+        """
+        Accumulated stages {stage: [seconds, calls]}, the profile is reset
+        """
+        stages, self.stages = self.stages, dict()
+        return stages
+
+
+def timed(stage):
+    """
+    Decorator of tracker methods: time of every call is added to `stage` of the profile of the tracker
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            start = default_timer()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.profile.add(stage, default_timer() - start)
+        return wrapper
+    return decorator
+
+
+def native_stage_times():
+    """
+    Array for the stage times of the native evolution: times of NATIVE_STAGES and number of sampled iterations
+    """
+    return np.zeros(len(NATIVE_STAGES) + 1, dtype=np.double)
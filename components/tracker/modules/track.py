@@ -10,13 +10,14 @@
 #
 
 import numpy as np
+from timeit import default_timer
 from skimage.feature import match_template
-from skimage.util import pad
 
 import parametrize as gparam
-from snakes import generate_matrix, sample_sf, constraint_forces, gen_gauss_kernel
-from utils import gen_potential
-from vfsampler.vfsampler import decode_vf, sample_vf
+from snakes import get_snake_solver, sample_sf, sample_gvf, constraint_forces, gen_gauss_kernel
+from utils import gen_potential_local, extract_window, insert_window, track_points, flow_image
+from timing import StageProfile, timed, native_stage_times
+from vfsampler.vfsampler import evolve_snake as native_evolve_snake
 
 from Queue import Queue
 
@@ -30,52 +31,157 @@ class TrackerParams(object):
         pass
 
 
-def match_and_track(point, img_curr, img_next, skel_next, img_branch_dt, wlarge=50, wsmall=10, corr_mult=15.0, branch_cost=1.0):
+def match_and_track(point, img_curr, img_next, skel_next, img_branch_dt=None, wlarge=50, wsmall=10, corr_mult=15.0,
+                    branch_cost=0.0, return_maps=False):
     """
     Track points by optimizing compound cost function
+    Only windows around `point` are read from the images, the parts of windows outside the images are zeros.
+    The distance map to branching points `img_branch_dt` is weighted by `branch_cost` (it is not read if the
+    weight is 0, it may be None then).
+    If `return_maps` is True, cross correlation on the skeleton and the penalty are also returned
+    (as images of the same shape as `img_curr`).
     """
-    # set padding width
-    pad_size = ((wlarge, wlarge), (wlarge, wlarge))
-    # set paddings
-    img_curr = pad(img_curr, pad_size, 'constant')
-    img_next = pad(img_next, pad_size, 'constant')
-    skel_next = pad(skel_next, pad_size, 'constant')
-    img_branch_dt = pad(img_branch_dt, pad_size, 'constant')
     # convert to the int type
-    pnt = point.astype(np.int) + wlarge
+    pnt = point.astype(np.int)
     # get template
-    template = img_curr[pnt[1]-wsmall:pnt[1]+wsmall+1, pnt[0]-wsmall:pnt[0]+wsmall+1]
+    template = extract_window(img_curr, pnt[0], pnt[1], wsmall)[0]
     # get search region
-    search_region = img_next[pnt[1]-wlarge:pnt[1]+wlarge+1, pnt[0]-wlarge:pnt[0]+wlarge+1]
+    search_region, offset = extract_window(img_next, pnt[0], pnt[1], wlarge)
     # get skeleton region
-    skel_region = skel_next[pnt[1]-wlarge:pnt[1]+wlarge+1, pnt[0]-wlarge:pnt[0]+wlarge+1]
-    # get branching image region
-    branch_dt_region = img_branch_dt[pnt[1]-wlarge:pnt[1]+wlarge+1, pnt[0]-wlarge:pnt[0]+wlarge+1]
+    skel_region = extract_window(skel_next, pnt[0], pnt[1], wlarge)[0]
     # match template
     match = match_template(search_region, template, pad_input=True)
-    # map to the skeleton
-    skel_match = match.copy()
-    skel_match[skel_region == 0] = 0.0
     # get coordinates of peeks
     peeks_r, peeks_c = np.where(skel_region)
     # calculate distance to the skeleton
     norm = np.sqrt((peeks_r - wlarge) ** 2 + (peeks_c - wlarge) ** 2)
     # calculate penalty
-    penalty = norm + corr_mult * np.abs(match.max() - match[peeks_r, peeks_c]) + branch_cost * 0.0 * branch_dt_region[peeks_r, peeks_c]
+    penalty = norm + corr_mult * np.abs(match.max() - match[peeks_r, peeks_c])
+    # add distance to branching points
+    if branch_cost != 0.0:
+        branch_dt_region = extract_window(img_branch_dt, pnt[0], pnt[1], wlarge)[0]
+        penalty += branch_cost * branch_dt_region[peeks_r, peeks_c]
     # find the point with the smallest penalty
     ii = np.argmin(penalty)
     # convert result to global coordinates
-    result_pnt = np.array([peeks_c[ii], peeks_r[ii]], dtype=pnt.dtype) + pnt - 2 * wlarge
+    result_pnt = np.array([peeks_c[ii], peeks_r[ii]], dtype=pnt.dtype) + offset
+    if not return_maps:
+        return result_pnt
     # output cross correlation on the skeleton
-    skel_match_out = np.zeros_like(img_curr, dtype=match.dtype)
-    skel_match_out[pnt[1]-wlarge:pnt[1]+wlarge+1, pnt[0]-wlarge:pnt[0]+wlarge+1][skel_region > 0] = match[skel_region > 0]
+    skel_match = np.zeros_like(match)
+    skel_match[peeks_r, peeks_c] = match[peeks_r, peeks_c]
+    skel_match_out = insert_window(np.zeros_like(img_curr, dtype=match.dtype), skel_match, offset)
     # output matching result
-    match_out = np.zeros_like(img_curr, dtype=match.dtype)
-    match_out[pnt[1]-wlarge:pnt[1]+wlarge+1, pnt[0]-wlarge:pnt[0]+wlarge+1][peeks_r, peeks_c] = penalty
+    penalty_match = np.zeros_like(match)
+    penalty_match[peeks_r, peeks_c] = penalty
+    match_out = insert_window(np.zeros_like(img_curr, dtype=match.dtype), penalty_match, offset)
     # return result
     return result_pnt, skel_match_out, match_out
 
 
+def window_integrals(images):
+    """
+    Integral images of `images` (K, H, W) with a leading zero row and column: shape (K, H + 1, W + 1)
+    """
+    integrals = np.zeros((images.shape[0], images.shape[1] + 1, images.shape[2] + 1), dtype=np.double)
+    np.cumsum(np.cumsum(images, axis=1), axis=2, out=integrals[:, 1:, 1:])
+    return integrals
+
+
+def match_candidates(images, templates, k, rows, cols):
+    """
+    Normalized cross-correlation of the images `images` (K, H, W) with their templates `templates` (K, h, w)
+    at the candidate pixels (`rows`, `cols`) of the images `k` only. The values are the same as those of
+    skimage.feature.match_template(image, template, pad_input=True) at these pixels: windows are centered at the
+    candidates and the images are zero outside. Window sums are taken from integral images.
+    """
+    count, height, width = images.shape
+    h, w = templates.shape[1:]
+
+    # pad images with zeros, so that the window of every candidate starts at its pixel of the padded image
+    r0, c0 = (h - 1) // 2, (w - 1) // 2
+    padded = np.zeros((count, height + h - 1, width + w - 1), dtype=np.double)
+    padded[:, r0:r0 + height, c0:c0 + width] = images
+
+    # window sums of the images at the candidates
+    integral, integral2 = window_integrals(padded), window_integrals(padded ** 2)
+    image_sum = integral[k, rows + h, cols + w] - integral[k, rows, cols + w] - \
+        integral[k, rows + h, cols] + integral[k, rows, cols]
+    image_sum2 = integral2[k, rows + h, cols + w] - integral2[k, rows, cols + w] - \
+        integral2[k, rows + h, cols] + integral2[k, rows, cols]
+
+    # statistics of the templates
+    template_mean = templates.mean(axis=(1, 2))
+    template_ssd = ((templates - template_mean.reshape(count, 1, 1)) ** 2).sum(axis=(1, 2))
+
+    # cross-correlation of the windows of the candidates
+    strides = padded.strides
+    windows = np.lib.stride_tricks.as_strided(padded, (count, height, width, h, w),
+                                              strides + strides[1:])[k, rows, cols]
+    xcorr = np.einsum('mij,mij->m', windows, templates[k])
+
+    # normalize
+    numerator = xcorr - image_sum * template_mean[k]
+    denominator = np.sqrt(np.maximum((image_sum2 - image_sum ** 2 / (h * w)) * template_ssd[k], 0))
+    response = np.zeros_like(numerator)
+    mask = denominator > np.finfo(np.float64).eps
+    response[mask] = numerator[mask] / denominator[mask]
+    return response
+
+
+def batch_match_and_track(points, img_curr, img_next, skel_next, img_branch_dt=None, wlarge=50, wsmall=10,
+                          corr_mult=15.0, branch_cost=0.0):
+    """
+    Track all `points` (K, 2) from `img_curr` to `img_next` at once by optimizing the cost function of
+    `match_and_track` (the same point is selected). Cross-correlation is evaluated at the skeleton pixels only
+    (see `match_candidates`): the maximum of the correlation in the cost is the same for all candidates
+    of a point, so that it does not change the selected candidate and is not computed.
+    Returns tracked points (K, 2) and mask of the points that are found: a point without skeleton pixels
+    in its search region is not tracked and keeps its position.
+    """
+    pnts = points.astype(np.int)
+    count, size = len(pnts), 2 * wlarge + 1
+    if count == 0:
+        return np.zeros((0, 2), dtype=pnts.dtype), np.zeros(0, dtype=np.bool)
+
+    # get templates, search regions and skeleton regions
+    templates = np.empty((count, 2 * wsmall + 1, 2 * wsmall + 1), dtype=np.double)
+    search_regions = np.empty((count, size, size), dtype=np.double)
+    skel_regions = np.empty((count, size, size), dtype=np.bool)
+    offsets = np.empty((count, 2), dtype=np.int)
+    for k, pnt in enumerate(pnts):
+        templates[k] = extract_window(img_curr, pnt[0], pnt[1], wsmall)[0]
+        search_regions[k], offsets[k] = extract_window(img_next, pnt[0], pnt[1], wlarge)
+        skel_regions[k] = extract_window(skel_next, pnt[0], pnt[1], wlarge)[0] != 0
+
+    # get coordinates of peeks (in the same order as in match_and_track)
+    peeks_k, peeks_r, peeks_c = np.nonzero(skel_regions)
+    found = np.zeros(count, dtype=np.bool)
+    found[peeks_k] = True
+    tracked = pnts.copy()
+    if len(peeks_k) == 0:
+        return tracked, found
+
+    # match templates at the peeks
+    match = match_candidates(search_regions, templates, peeks_k, peeks_r, peeks_c)
+
+    # calculate penalty (without the maximum of the correlation)
+    norm = np.sqrt((peeks_r - wlarge) ** 2 + (peeks_c - wlarge) ** 2)
+    penalty = norm - corr_mult * match
+    if branch_cost != 0.0:
+        branch_dt = np.array([extract_window(img_branch_dt, pnt[0], pnt[1], wlarge)[0] for pnt in pnts])
+        penalty += branch_cost * branch_dt[peeks_k, peeks_r, peeks_c]
+
+    # find the first peek with the smallest penalty of every point (sorting is stable)
+    order = np.lexsort((penalty, peeks_k))
+    first = np.flatnonzero(np.r_[True, peeks_k[order][1:] != peeks_k[order][:-1]])
+    ii = order[first]
+
+    # convert results to global coordinates (peeks are sorted by point)
+    tracked[found] = np.column_stack([peeks_c[ii], peeks_r[ii]]) + offsets[found]
+    return tracked, found
+
+
 def shortest_path_bfs(mask, row1, col1, row2, col2):
     q = Queue()
     q.put((row1, col1))
@@ -121,6 +227,145 @@ def shortest_path_bfs(mask, row1, col1, row2, col2):
     return []
 
 
+def start_recording(trajectory, points):
+    """
+    Record initial snake `points` to `trajectory` of the evolution (if it is not None)
+    """
+    if trajectory is not None:
+        trajectory[0] = points
+
+
+def record_iteration(trajectory, history, iter_i, points):
+    """
+    Record snake `points` of iteration `iter_i` to `trajectory` and ring buffer `history` (if they are not None)
+    """
+    if trajectory is not None:
+        trajectory[iter_i] = points
+    if history is not None:
+        history[(iter_i - 1) % len(history)] = points
+
+
+def finish_recording(trajectory, history, iter_i, points):
+    """
+    Fill the rest of `trajectory` with the converged snake `points` and order the ring buffer `history`
+    from the oldest to the latest iteration
+    """
+    if trajectory is not None:
+        trajectory[iter_i+1::] = points
+    if history is not None:
+        history_size = len(history)
+        if iter_i < history_size:
+            history[iter_i:] = points
+        else:
+            history[:] = np.roll(history, -(iter_i % history_size), axis=0)
+
+
+class FilamentState(object):
+    """
+    Tracking state of a single filament: converged snakes, endpoint trajectories and branching
+    potentials at the endpoints on the current frame. Frames `first_frame`, ..., `frame_n` - 1 are tracked,
+    arrays of the state are indexed by `image_i` - `first_frame`.
+    """
+
+    def __init__(self, initial_positions, frame_n, iter_n, full_trajectory=False, history_size=0,
+                 potential_window=None, first_frame=0, compare_iterations=False):
+
+        # Get number of points in snake
+        self.point_n = N = len(initial_positions)
+
+        # First tracked frame
+        self.first_frame = first_frame
+        frame_n = max(frame_n - first_frame, 0)
+
+        # Converged snakes on every frame
+        self.snake_contours = np.zeros((frame_n, N, 2), dtype=np.double)
+
+        # Number of iterations made on every frame
+        self.iterations = np.zeros(frame_n, dtype=np.int)
+
+        # Iterations saved by the warm start on every frame (kept only if they are compared)
+        self.iterations_saved = None
+        if compare_iterations:
+            self.iterations_saved = np.zeros(frame_n, dtype=np.int)
+
+        # Iterations made on the coarse levels of the GVF pyramid on every frame (see `Tracker.evolve_coarse`)
+        self.coarse_iterations = np.zeros(frame_n, dtype=np.int)
+
+        # Initial snake on the current frame before the warm start (kept only if the iterations are compared)
+        self.cold_init = None
+
+        # Trajectories of the snakes during evolution (kept only in the 'full' mode)
+        self.snake_traj = None
+        if full_trajectory:
+            self.snake_traj = np.zeros((frame_n, iter_n + 1, N, 2), dtype=np.double)
+
+        # Last iterations of the evolution on every frame
+        self.snake_history = None
+        if history_size > 0:
+            self.snake_history = np.zeros((frame_n, history_size, N, 2), dtype=np.double)
+
+        # Initial snake on the current frame
+        self.snake_init = np.asarray(initial_positions, dtype=np.double)
+
+        # Trajectories of branching points at the ends
+        self.ends_traj = np.zeros((frame_n, 2, 2), dtype=np.double)
+
+        # Sampled intensities
+        self.snake_intensities = np.zeros((frame_n, N), dtype=np.int)
+
+        # Branching potentials around the endpoints and offsets of their windows (optional)
+        self.branching_potentials, self.branching_offsets = None, None
+        if potential_window is not None:
+            window_size = 2 * potential_window + 1
+            self.branching_potentials = np.zeros((frame_n, 2, window_size, window_size), dtype=np.double)
+            self.branching_offsets = np.zeros((frame_n, 2, 2), dtype=np.int)
+
+        # Endpoints initialized
+        self.endpoint_initialized = [False, False]
+
+        # Potential, forces, mask and offset of the branching potential at both endpoints on the current frame
+        self.branching = None
+
+        # Final state of the previous run (if the tracking is continued)
+        self.previous_state = None
+
+    def trajectory(self, image_i):
+        return None if self.snake_traj is None else self.snake_traj[image_i - self.first_frame]
+
+    def history(self, image_i):
+        return None if self.snake_history is None else self.snake_history[image_i - self.first_frame]
+
+    def final_state(self):
+        """
+        State after the last tracked frame, tracking of the filament can be continued from it on appended frames
+        (see `Tracker.resume`)
+        """
+        if len(self.snake_contours) == 0:
+            return self.previous_state
+        return {
+            "frame": self.first_frame + len(self.snake_contours) - 1,
+            "contour": self.snake_contours[-1],
+            "ends": self.ends_traj[-1],
+            "initialized": np.array(self.endpoint_initialized, dtype=np.bool)
+        }
+
+    def result(self):
+        return {
+            "snake_contours": self.snake_contours,
+            "snake_trajectory": self.snake_traj,
+            "snake_history": self.snake_history,
+            "snake_iterations": self.iterations,
+            "iterations_saved": self.iterations_saved,
+            "coarse_iterations": self.coarse_iterations,
+            "branching_potential": self.branching_potentials,
+            "branching_offsets": self.branching_offsets,
+            "ends_trajectories": self.ends_traj,
+            "snake_intensities": self.snake_intensities,
+            "first_frame": self.first_frame,
+            "final_state": self.final_state()
+        }
+
+
 class Tracker:
 
     def __init__(self, image_sequence, params=None, lock=None):
@@ -134,6 +379,17 @@ class Tracker:
             params.max_iter_n = 600
             params.dt = 0.01
             params.min_shift = 1.0e-7
+            params.trajectory_mode = 'compact'
+            params.history_size = 0
+            params.store_potentials = False
+            params.potential_window = 15
+            params.warm_start = 'none'
+            params.flow_max_shift = 10.0
+            params.compare_warm_start = False
+            params.resolution_levels = 1
+            params.coarse_iter_n = 200
+            params.coarse_min_shift = 1.0e-3
+            params.branch_cost = 0.0
 
         # Initialize image sequence
         self.image_sequence = image_sequence
@@ -141,8 +397,9 @@ class Tracker:
         # Generate gaussian kernel
         self.gauss_kernel = gen_gauss_kernel(params.kernel_sigma, params.kernel_size)
 
-        # Snake matrix
-        self.U = 0
+        # Solver of the snake evolution system
+        self.solver = None
+        self.snake_buffer = None
 
         # Set lock for parallel computing
         self.lock = lock
@@ -163,158 +420,435 @@ class Tracker:
         # Motion threshold
         self.motion_threshold = params.min_shift
 
-    def track(self, initial_positions, log):
+        # Storage of the evolution: 'compact' keeps converged contours only, 'full' keeps every iteration
+        self.trajectory_mode = params.trajectory_mode
+
+        # Number of last iterations kept per frame (ring buffer, 0 disables)
+        self.history_size = params.history_size
+
+        # Keep branching potentials in windows of size (2 * potential_window + 1) around the endpoints
+        self.store_potentials = params.store_potentials
+        self.potential_window = params.potential_window
+
+        # Advect initial snakes with optical flow before the evolution ('flow') or start from the previous contours
+        self.flow_warm_start = params.warm_start == 'flow'
+        self.flow_max_shift = params.flow_max_shift
+
+        # Evolve snakes also without the warm start to count the iterations it saves (doubles the evolution time)
+        self.compare_warm_start = self.flow_warm_start and params.compare_warm_start
+
+        # uint8 frames of the optical flow (the current frame pair)
+        self.flow_frames = dict()
+
+        # Weight of the distance to branching points in the cost of endpoint tracking (see `match_and_track`)
+        self.branch_cost = params.branch_cost
+
+        # Levels of the GVF pyramid (1 evolves at full resolution only), maximum iterations and minimum shift
+        # (convergence threshold) on a coarse level
+        self.resolution_levels = params.resolution_levels
+        self.coarse_iter_n = params.coarse_iter_n
+        self.coarse_min_shift = params.coarse_min_shift
+
+        # Time and calls of the tracking stages, stages of the native evolution are timed on sampled iterations
+        self.profile = StageProfile()
+        self.stage_times = native_stage_times()
+
+    def start(self, initial_positions):
         """
-        Track
+        Create tracking state of the filament with `initial_positions` on the first frame.
+        If `initial_positions` is the final state of a previous run (see `FilamentState.final_state`),
+        tracking is continued after its last frame (see `resume`).
         """
-        # Get image sequence shape
-        frame_n, im_r, im_c = self.image_sequence.enhanced.shape
-        log += "  [Tracker] : number of images: " + str(frame_n)
+        if isinstance(initial_positions, dict):
+            return self.resume(initial_positions)
+        frame_n = self.image_sequence.enhanced.shape[0]
+        return FilamentState(initial_positions, frame_n, self.max_iter_n, self.trajectory_mode == 'full',
+                             self.history_size, self.potential_window if self.store_potentials else None,
+                             compare_iterations=self.compare_warm_start)
+
+    def resume(self, final_state):
+        """
+        Create tracking state that continues tracking of a filament on the frames after the last frame of
+        `final_state` (frames appended to the image sequence): the last contour is the initial snake, the
+        endpoints are tracked from the last frame to the next one
+        """
+        frame_n = self.image_sequence.enhanced.shape[0]
+        last_frame = int(final_state["frame"])
+        state = FilamentState(final_state["contour"], frame_n, self.max_iter_n, self.trajectory_mode == 'full',
+                              self.history_size, self.potential_window if self.store_potentials else None,
+                              first_frame=last_frame + 1, compare_iterations=self.compare_warm_start)
+        state.endpoint_initialized = [bool(flag) for flag in final_state["initialized"]]
+        state.previous_state = final_state
+
+        if last_frame + 1 < frame_n:
+            state.ends_traj[0] = self.track_endpoints(final_state["ends"], last_frame)
+        return state
+
+    @timed('potentials')
+    def prepare_frame(self, state, image_i):
+        """
+        Generate branching potentials at both endpoints of the filament on frame `image_i`
+        """
+        image_shape = self.image_sequence.enhanced.shape[1:]
+        frame_i = image_i - state.first_frame
 
-        # Get number of points in snake
-        N = len(initial_positions)
+        if not state.endpoint_initialized[0] or not state.endpoint_initialized[1]:
+            frame_branching = self.frame_potential(image_i, image_shape)
 
-        # Generate stiffness matrix
-        A = generate_matrix(N, self.alpha, self.beta)
+        state.branching = []
+        for end_i in xrange(2):
+            if state.endpoint_initialized[end_i]:
+                state.branching.append(gen_potential_local(state.ends_traj[frame_i][end_i].reshape(1, 2),
+                                                           image_shape, self.gauss_kernel))
+            else:
+                state.branching.append(frame_branching)
 
-        # Generate snake matrix
-        self.U = np.linalg.inv(np.eye(N, N) - self.dt * A)
+    def finish_frame(self, state, image_i, track_ends=True):
+        """
+        Process the converged snake of frame `image_i`: sample intensities, initialize endpoints
+        and track them to the next frame (if `track_ends` is False, see `track_next_endpoints`)
+        """
+        frame_n = self.image_sequence.enhanced.shape[0]
+        frame_i = image_i - state.first_frame
 
-        # Get number of iterations
-        iter_n = self.max_iter_n
+        contour = state.snake_contours[frame_i]
+        (br_p0, br_f0, br_m0, br_o0), (br_p1, br_f1, br_m1, br_o1) = state.branching
 
-        # Trajectories of the snakes during tracking and evolution
-        snake_traj = np.zeros((frame_n, iter_n + 1, N, 2), dtype=np.double)
-        snake_traj[0][0] = initial_positions
+        # sample intensities
+        state.snake_intensities[frame_i] = sample_sf(self.image_sequence.binaries[image_i], contour,
+                                                     interp=False).ravel()
 
-        # Trajectories of branching points at the ends
-        ends_traj = np.zeros((frame_n, 2, 2), dtype=np.double)
+        # set trajectory of the endpoints
+        if not state.endpoint_initialized[0]:
+            state.endpoint_initialized[0] = True
+            indices = sample_sf(br_m0, contour[0, :].reshape(1, 2), interp=False, offset=br_o0).ravel()
 
-        # Sampled intensities
-        snake_intensities = np.zeros((frame_n, N), dtype=np.int)
+            state.ends_traj[frame_i][0] = self.image_sequence.branching_coords[image_i][indices[0] - 1]
 
-        # Branching points
-        branching_potentials = np.zeros((frame_n, 2, im_r, im_c), dtype=np.double)  # branching potential
+        if not state.endpoint_initialized[1]:
+            state.endpoint_initialized[1] = True
+            indices = sample_sf(br_m1, contour[-1, :].reshape(1, 2), interp=False, offset=br_o1).ravel()
 
-        # Endpoints initialized
-        endpoint_initialized = [False, False]
+            state.ends_traj[frame_i][1] = self.image_sequence.branching_coords[image_i][indices[0] - 1]
+
+        # crop branching potentials around the endpoints
+        if state.branching_potentials is not None:
+            for end_i, (br_p, br_o) in enumerate([(br_p0, br_o0), (br_p1, br_o1)]):
+                end_x, end_y = state.ends_traj[frame_i][end_i] - br_o
+                window, window_offset = extract_window(br_p, end_x, end_y, self.potential_window)
+                state.branching_potentials[frame_i, end_i] = window
+                state.branching_offsets[frame_i, end_i] = window_offset + br_o
+
+        # Use optical flow to translate contour to the next frame
+        if image_i + 1 < frame_n:
+
+            # Set next snake trajectory
+            state.snake_init = contour
+
+            if track_ends:
+                state.ends_traj[frame_i + 1] = self.track_endpoints(state.ends_traj[frame_i], image_i)
+
+    def track_next_endpoints(self, states, image_i):
+        """
+        Track endpoints of all `states` from frame `image_i` to the next frame at once.
+        Returns states whose endpoints are lost (no skeleton pixels around them), they are not changed.
+        """
+        frame_n = self.image_sequence.enhanced.shape[0]
+        if image_i + 1 >= frame_n or len(states) == 0:
+            return []
+        tracked, found = self.track_endpoints_batch([state.ends_traj[image_i - state.first_frame]
+                                                     for state in states], image_i)
+        for state, ends, is_found in zip(states, tracked, found):
+            if is_found:
+                state.ends_traj[image_i + 1 - state.first_frame] = ends
+        return [state for state, is_found in zip(states, found) if not is_found]
+
+    def track_endpoints(self, ends, image_i):
+        """
+        Track both endpoints `ends` from frame `image_i` to the next frame
+        """
+        tracked, found = self.track_endpoints_batch([ends], image_i)
+        if not found[0]:
+            raise ValueError("no skeleton pixels in the search region of an endpoint")
+        return tracked[0]
+
+    @timed('endpoint_matching')
+    def track_endpoints_batch(self, ends_list, image_i):
+        """
+        Track both endpoints of every item of `ends_list` from frame `image_i` to the next frame,
+        template matching of all endpoints is done at once (see `batch_match_and_track`).
+        Returns tracked endpoints of the items and whether both of them are found.
+        """
+        # Get enhanced images on the current and the next frame
+        enhanced_image = self.image_sequence.enhanced[image_i]
+        enhanced_image_next = self.image_sequence.enhanced[image_i+1]
+
+        # Get skeleton image
+        skeleton_next = self.image_sequence.skeletons[image_i+1]
+
+        # Get branching image (it is loaded only if it is weighted)
+        branch_img_next = None
+        if self.branch_cost != 0.0:
+            branch_img_next = self.image_sequence.branching[image_i+1]
+
+        points = np.asarray(ends_list, dtype=np.double).reshape(-1, 2)
+        tracked, found = batch_match_and_track(points, enhanced_image, enhanced_image_next, skeleton_next,
+                                               branch_img_next, branch_cost=self.branch_cost)
+        return list(tracked.reshape(-1, 2, 2)), list(found.reshape(-1, 2).all(axis=1))
+
+    def track(self, initial_positions, log):
+        """
+        Track the filament from `initial_positions` (snake or final state of a previous run, see `start`)
+        """
+        # Get image sequence shape
+        frame_n = self.image_sequence.enhanced.shape[0]
+        log += "  [Tracker] : number of images: " + str(frame_n)
+
+        # Initialize tracking state
+        state = self.start(initial_positions)
 
         # Track snake and branching points at the ends
-        for image_i in xrange(frame_n):
+        for image_i in xrange(state.first_frame, frame_n):
 
             # Print current frame index
             log += "  [Tracker] : current frame: " + str(image_i)
 
-            # Get enhanced image
-            enhanced_image = self.image_sequence.enhanced[image_i]
+            self.track_frame(state, image_i)
 
-            # Get binary image
-            binary_image = self.image_sequence.binaries[image_i]
+        return state.result()
 
-            # Get gradient vector flow
-            gvf = self.image_sequence.gvf_magnitude[image_i], self.image_sequence.gvf_angle[image_i]
-
-            if not endpoint_initialized[0] or not endpoint_initialized[1]:
-                br_coords = self.image_sequence.branching_coords[image_i]
-                br_potential, br_force, br_mask = gen_potential(br_coords, enhanced_image.shape, self.gauss_kernel)
+    def track_frame(self, state, image_i, warm_start=True, track_ends=True):
+        """
+        Evolve the snake of the filament `state` on frame `image_i` and track its endpoints to the next frame.
+        If `warm_start` is False, the initial snake is expected to be advected already (see `warm_start`),
+        if `track_ends` is False, the endpoints are tracked later (see `track_next_endpoints`).
+        """
+        # Get number of points in snake
+        N = state.point_n
 
-            if endpoint_initialized[0]:
-                br_p0, br_f0, br_m0 = gen_potential(ends_traj[image_i][0].reshape(1, 2), enhanced_image.shape, self.gauss_kernel)
-            else:
-                br_p0, br_f0, br_m0 = br_potential, br_force, br_mask
+        # Advect the initial snake with optical flow
+        if warm_start:
+            self.warm_start([state], image_i)
 
-            if endpoint_initialized[1]:
-                br_p1, br_f1, br_m1 = gen_potential(ends_traj[image_i][1].reshape(1, 2), enhanced_image.shape,
-                                                    self.gauss_kernel)
-            else:
-                br_p1, br_f1, br_m1 = br_potential, br_force, br_mask
+        # Get factorized snake matrix and work buffer of the native evolution (they depend on N only)
+        self.set_solver(N)
 
-            branching_potentials[image_i, 0] = br_p0
-            branching_potentials[image_i, 1] = br_p1
+        # Get enhanced image
+        enhanced_image = self.image_sequence.enhanced[image_i]
 
-            log += "  [Tracker] Snake evolution."
+        # Get gradient vector flow
+        gvf = self.gvf_field(image_i)
 
-            # evolve snake
-            snake_traj[image_i] = self.evolve_snake(snake_traj[image_i], gvf, enhanced_image, br_f0, br_f1, iter_n,
-                                                    self.dt, N)
+        # Generate branching potentials at the endpoints
+        self.prepare_frame(state, image_i)
+        (br_p0, br_f0, br_m0, br_o0), (br_p1, br_f1, br_m1, br_o1) = state.branching
 
-            # sample intensities
-            snake_intensities[image_i] = sample_sf(binary_image, snake_traj[image_i][iter_n], interp=False).ravel()
+        # Evolve the snake on the coarse levels of the GVF pyramid
+        iter_n = self.evolve_coarse(state, image_i)
 
-            # set trajectory of the endpoints
-            if not endpoint_initialized[0]:
-                endpoint_initialized[0] = True
-                indices = sample_sf(br_m0.astype(np.int), snake_traj[image_i][iter_n][0, :].reshape(1, 2),
-                                    interp=False).ravel()
+        # evolve snake
+        frame_i = image_i - state.first_frame
+        state.snake_contours[frame_i], state.iterations[frame_i] = \
+            self.evolve_snake(state.snake_init, gvf, enhanced_image, br_f0, br_f1, iter_n, self.dt, N,
+                              state.trajectory(image_i), state.history(image_i), br_offsets=(br_o0, br_o1))
 
-                ends_traj[image_i][0] = self.image_sequence.branching_coords[image_i][indices[0] - 1]
+        # Count iterations saved by the warm start
+        self.compare_iterations(state, image_i)
 
-            if not endpoint_initialized[1]:
-                endpoint_initialized[1] = True
-                indices = sample_sf(br_m1.astype(np.int), snake_traj[image_i][iter_n][-1, :].reshape(1, 2),
-                                    interp=False).ravel()
+        self.finish_frame(state, image_i, track_ends)
 
-                ends_traj[image_i][1] = self.image_sequence.branching_coords[image_i][indices[0] - 1]
+    def set_solver(self, N):
+        """
+        Get factorized snake matrix and work buffer of the native evolution for snakes of `N` points
+        """
+        self.solver = get_snake_solver(N, self.alpha, self.beta, self.dt)
+        if self.snake_buffer is None or self.snake_buffer.shape[1] != N:
+            self.snake_buffer = np.empty((5, N), dtype=np.double)
 
-            # Use optical flow to translate contour to the next frame
-            if image_i + 1 < frame_n:
+    def flow_frame(self, image_i):
+        """
+        uint8 image of frame `image_i` for the optical flow, only the frames of the current pair are kept
+        """
+        if image_i not in self.flow_frames:
+            for key in [key for key in self.flow_frames if key < image_i - 1]:
+                del self.flow_frames[key]
+            self.flow_frames[image_i] = flow_image(self.image_sequence.enhanced[image_i])
+        return self.flow_frames[image_i]
 
-                # Set next snake trajectory
-                snake_traj[image_i + 1][0][:, 0] = snake_traj[image_i][iter_n][:, 0]  # result_x.copy()#next_x#result_x.copy()
-                snake_traj[image_i + 1][0][:, 1] = snake_traj[image_i][iter_n][:, 1]  # result_y.copy()#next_y#result_y.copy()
+    def warm_start(self, states, image_i):
+        """
+        Advect initial snakes of `states` from the previous frame to frame `image_i` with pyramidal Lucas-Kanade
+        optical flow (points of all snakes are tracked at once), the advected snakes are reparametrized
+        """
+        if not self.flow_warm_start or image_i == 0 or len(states) == 0:
+            return
+
+        with self.profile.measure('warm_start'):
+            points = np.vstack([state.snake_init for state in states])
+            x, y = track_points(self.flow_frame(image_i - 1), self.flow_frame(image_i), points[:, 0], points[:, 1],
+                                self.flow_max_shift)
+            advected = np.column_stack([x, y])
+
+            starts = np.cumsum([0] + [state.point_n for state in states])
+            for k, state in enumerate(states):
+                if self.compare_warm_start:
+                    state.cold_init = state.snake_init
+                state.snake_init, _ = gparam.reparametrize_contour(advected[starts[k]:starts[k + 1]], state.point_n)
+
+    def compare_iterations(self, state, image_i):
+        """
+        Evolve the snake of `state` on frame `image_i` from its initial snake before the warm start and store
+        the number of iterations saved by the warm start (the evolution itself is discarded)
+        """
+        if state.cold_init is None:
+            return
+
+        frame_i = image_i - state.first_frame
+        (br_p0, br_f0, br_m0, br_o0), (br_p1, br_f1, br_m1, br_o1) = state.branching
+        self.set_solver(state.point_n)
+        _, cold_iterations = self.evolve_snake(state.cold_init, self.gvf_field(image_i),
+                                               self.image_sequence.enhanced[image_i], br_f0, br_f1,
+                                               self.max_iter_n, self.dt, state.point_n, br_offsets=(br_o0, br_o1))
+        state.iterations_saved[frame_i] = cold_iterations - state.iterations[frame_i]
+        state.cold_init = None
+
+    def evolve_coarse(self, state, image_i):
+        """
+        Coarse-to-fine initialization: evolve the initial snake of `state` on frame `image_i` on the levels
+        l = `resolution_levels` - 1, ..., 1 of the GVF pyramid (see `gvf_pyramid` of image.py). On the level l the
+        snake is decimated by 2^l, the time step is multiplied by 2^l and the elasticity and rigidity are divided
+        by 4^l and 16^l. A level is finished when the snake moves less than `coarse_min_shift` per iteration (or after
+        `coarse_iter_n` iterations), the result is reparametrized back to the initial snake.
+        Returns the maximum number of iterations at full resolution: `max_iter_n` less the coarse iterations.
+        """
+        if self.resolution_levels < 2 or not hasattr(self.image_sequence, 'gvf_x_1'):
+            return self.max_iter_n
+
+        # Decimated snakes and their solvers (the coarse solvers are cached as the full resolution one)
+        levels = []
+        for level in xrange(self.resolution_levels - 1, 0, -1):
+            scale = 2 ** level
+            point_n = max(int(round((state.point_n - 1.0) / scale)) + 1, 3)
+            solver = get_snake_solver(point_n, self.alpha / scale ** 2, self.beta / scale ** 4, self.dt * scale)
+            levels.append((level, scale, point_n, solver))
+        if not all(solver.is_banded for _, _, _, solver in levels):
+            return self.max_iter_n
+
+        with self.profile.measure('coarse_evolution'):
+            (br_p0, br_f0, br_m0, br_o0), (br_p1, br_f1, br_m1, br_o1) = state.branching
+            enhanced_image = self.image_sequence.enhanced[image_i]
 
-                # Get enhanced image on the next frame
-                enhanced_image_next = self.image_sequence.enhanced[image_i+1]
+            points, iterations = state.snake_init, 0
+            for level, scale, point_n, solver in levels:
+                points, _ = gparam.reparametrize_contour(np.ascontiguousarray(points, dtype=np.double), point_n)
 
-                # Get skeleton image
-                skeleton_next = self.image_sequence.skeletons[image_i+1]
+                # Evolve the snake on the level of the pyramid
+                gvf = (getattr(self.image_sequence, 'gvf_x_{0}'.format(level))[image_i],
+                       getattr(self.image_sequence, 'gvf_y_{0}'.format(level))[image_i])
+                iterations += native_evolve_snake(points, gvf, enhanced_image, br_f0, br_f1, (br_o0, br_o1),
+                                                  solver.factor, self.dt * scale,
+                                                  min(self.coarse_iter_n, self.max_iter_n - iterations),
+                                                  max(self.motion_threshold, self.coarse_min_shift) * scale,
+                                                  gvf_scale=2.0 / scale)
 
-                # Get branching image
-                branch_img_next = self.image_sequence.branching[image_i+1]
+            state.snake_init, _ = gparam.reparametrize_contour(points, state.point_n)
+            state.coarse_iterations[image_i - state.first_frame] = iterations
 
-                for end_i in xrange(2):
-                    ends_traj[image_i + 1][end_i] = match_and_track(ends_traj[image_i][end_i],
-                                                                    enhanced_image,
-                                                                    enhanced_image_next,
-                                                                    skeleton_next,
-                                                                    branch_img_next)[0]
+        return self.max_iter_n - iterations
 
-        return {
-            "snake_trajectory": snake_traj,
-            "branching_potential": branching_potentials,
-            "ends_trajectories": ends_traj,
-            "snake_intensities": snake_intensities
-        }
+    def gvf_field(self, image_i):
+        """
+        Gradient vector flow on frame `image_i`: decoded float32 (x, y) components if the image sequence
+        keeps them (see `decode_gvf` of image.py), otherwise uint8 (magnitude, angle) images
+        """
+        if hasattr(self.image_sequence, 'gvf_x'):
+            return self.image_sequence.gvf_x[image_i], self.image_sequence.gvf_y[image_i]
+        return self.image_sequence.gvf_magnitude[image_i], self.image_sequence.gvf_angle[image_i]
 
-    def evolve_snake(self, snake_traj, gvf_result, enhanced_image, br_f0, br_f1, iter_n, dt, point_n):
-        # evolve snake
+    def frame_potential(self, image_i, image_shape):
+        """
+        Branching potential of all branching points on frame `image_i`.
+        It is taken from the precomputed layers of the image sequence (shared by all filaments) if they contain
+        this frame, otherwise it is generated. Returns potential, forces, mask and offset of the window.
+        """
+        frames = getattr(self.image_sequence, 'branching_frames', None)
+        if frames is not None:
+            slots = np.flatnonzero(frames == image_i)
+            if len(slots) > 0:
+                i = slots[0]
+                return (self.image_sequence.branching_potential[i],
+                        (self.image_sequence.branching_force_x[i], self.image_sequence.branching_force_y[i]),
+                        self.image_sequence.branching_mask[i],
+                        np.zeros(2, dtype=np.int))
+
+        return gen_potential_local(self.image_sequence.branching_coords[image_i], image_shape, self.gauss_kernel)
+
+    @timed('evolution')
+    def evolve_snake(self, initial_points, gvf_result, enhanced_image, br_f0, br_f1, iter_n, dt, point_n,
+                     trajectory=None, history=None, br_offsets=None):
+        """
+        Evolve snake starting from `initial_points` until it converges or `iter_n` iterations are made.
+        Every iteration is written to `trajectory` of shape (M, N, 2), M > `iter_n` (the rows after the last
+        iteration are filled with the converged snake), and the last iterations are kept in the ring buffer
+        `history` of shape (K, N, 2), if given.
+        `br_offsets` are offsets (x, y) of the windows of branching forces `br_f0` and `br_f1`.
+        Returns the converged snake and the number of iterations made.
+        """
+        if self.solver.is_banded:
+            # run the whole iteration loop natively (without the GIL)
+            curr_points = np.array(initial_points, dtype=np.double)
+            start_recording(trajectory, curr_points)
+            self.stage_times.fill(0.0)
+            start = default_timer()
+            iter_i = native_evolve_snake(curr_points, gvf_result, enhanced_image, br_f0, br_f1, br_offsets,
+                                         self.solver.factor, dt, iter_n, self.motion_threshold,
+                                         trajectory=None if trajectory is None else trajectory[:iter_n + 1],
+                                         history=history, buffer=self.snake_buffer,
+                                         stage_times=self.stage_times)
+            self.profile.add_native(self.stage_times, iter_i, default_timer() - start)
+            finish_recording(trajectory, history, iter_i, curr_points)
+            return curr_points, iter_i
+
+        curr_points = initial_points
+
+        start_recording(trajectory, curr_points)
+
+        # Reparametrized snakes are written to these buffers in turn (the result must not overlap the current snake)
+        reparametrized = np.empty((2, point_n, 2), dtype=np.double)
+
+        iter_i = 0
         for iter_i in xrange(1, iter_n + 1):
-            curr_points = snake_traj[iter_i - 1]
 
             # sample vector field
-            gvf_vecs = decode_vf(gvf_result[0], gvf_result[1], (2.0 * curr_points))
+            with self.profile.measure('gvf_sampling'):
+                gvf_vecs = sample_gvf(gvf_result, curr_points)
 
             # compute constraint forces
-            constraint_force = constraint_forces(enhanced_image, br_f0, br_f1, curr_points)
+            with self.profile.measure('constraint_forces'):
+                constraint_force = constraint_forces(enhanced_image, br_f0, br_f1, curr_points,
+                                                     br_offsets=br_offsets)
 
-            result_x = self.U.dot(curr_points[:, 0] + dt * (gvf_vecs[:, 0] + constraint_force[:, 0]))
-            result_y = self.U.dot(curr_points[:, 1] + dt * (gvf_vecs[:, 1] + constraint_force[:, 1]))
-            # track results
-            snake_traj[iter_i][:, 0] = result_x
-            snake_traj[iter_i][:, 1] = result_y
+            with self.profile.measure('linear_solve'):
+                result = self.solver.solve(curr_points + dt * (gvf_vecs + constraint_force))
 
-            snake_traj[iter_i][:, 0], snake_traj[iter_i][:, 1], step = gparam.uniform_contour_reparametrization_n(
-                snake_traj[iter_i][:, 0], snake_traj[iter_i][:, 1], point_n)
+            with self.profile.measure('reparametrization'):
+                next_points, step = gparam.reparametrize_contour(np.ascontiguousarray(result), point_n,
+                                                                 out=reparametrized[iter_i % 2],
+                                                                 buffer=self.snake_buffer[0])
+            # track results
+            record_iteration(trajectory, history, iter_i, next_points)
 
             # quantify the motion of the snake
-            dx = snake_traj[iter_i][:, 0] - snake_traj[iter_i-1][:, 0]
-            dy = snake_traj[iter_i][:, 1] - snake_traj[iter_i-1][:, 1]
+            dx = next_points[:, 0] - curr_points[:, 0]
+            dy = next_points[:, 1] - curr_points[:, 1]
             ds = np.sqrt(dx ** 2 + dy ** 2).mean()
 
+            curr_points = next_points
+
             if ds < self.motion_threshold:
-                snake_traj[iter_i+1::][..., 0] = snake_traj[iter_i][:, 0]
-                snake_traj[iter_i+1::][..., 1] = snake_traj[iter_i][:, 1]
-                return snake_traj
+                break
+
+        finish_recording(trajectory, history, iter_i, curr_points)
 
-        return snake_traj
+        return curr_points, iter_i
 
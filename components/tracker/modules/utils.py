@@ -16,32 +16,38 @@ from skimage import filters
 from fpattern.fpattern import fill_pattern_coords
 
 
-def track_points(img_prev, img_curr, x, y, max_shift=10.0):
+def flow_image(image):
+    """
+    Convert an image with intensities in [0, 1] to the uint8 image used by the optical flow (uint8 images are kept)
+    """
+    if image.dtype == np.uint8:
+        return image
+    return (image * 255).astype(np.uint8)
 
+
+def track_points(img_prev, img_curr, x, y, max_shift=10.0):
+    """
+    Track points (`x`, `y`) from `img_prev` to `img_curr` with pyramidal Lucas-Kanade optical flow
+    (all points in a single call). Images are uint8 or have intensities in [0, 1].
+    Points that are lost or shifted by more than `max_shift` keep their positions.
+    """
     lk_params = dict(winSize=(15, 15),
                      maxLevel=6,
                      criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.01))
 
-    points_num = len(x)
-    points = np.zeros((points_num, 1, 2), dtype=np.float32)
-
-    for i in xrange(points_num):
-        points[i][0][0] = x[i]
-        points[i][0][1] = y[i]
-
-    img_prev_i = (img_prev * 255).astype(np.uint8)
-    img_curr_i = (img_curr * 255).astype(np.uint8)
+    x = np.asarray(x, dtype=np.double)
+    y = np.asarray(y, dtype=np.double)
+    points = np.dstack([x, y]).astype(np.float32).reshape(-1, 1, 2)
 
-    print "RUN cv2.calcOpticalFlowPyrLK"
-    updated, st, err = cv2.calcOpticalFlowPyrLK(img_prev_i, img_curr_i, points, None, **lk_params)
-    print "FINISH cv2.calcOpticalFlowPyrLK"
+    updated, st, err = cv2.calcOpticalFlowPyrLK(flow_image(img_prev), flow_image(img_curr), points, None,
+                                                **lk_params)
 
-    x_new = updated[:, :, 0].ravel()
-    y_new = updated[:, :, 1].ravel()
+    x_new = updated[:, 0, 0].astype(np.double)
+    y_new = updated[:, 0, 1].astype(np.double)
 
     shifts = np.sqrt((x - x_new) ** 2 + (y - y_new) ** 2)
 
-    mask = shifts > max_shift
+    mask = (shifts > max_shift) | (st.ravel() == 0) | ~np.isfinite(shifts)
     x_new[mask] = x[mask]
     y_new[mask] = y[mask]
 
@@ -90,6 +96,39 @@ def track_branching_points(image_i, branch_traj, branch_index, branching_coords)
     return ok0, ok1
 
 
+def extract_window(image, x, y, half_size, fill_value=0):
+    """
+    Extract window of size (2 * `half_size` + 1) centered at point (`x`, `y`) of `image`.
+    The part of the window outside the image is filled with `fill_value`.
+    Returns window and offset (x, y) of its top-left corner in image coordinates.
+    """
+    rows, cols = image.shape[:2]
+    size = 2 * half_size + 1
+    # top-left corner of the window
+    x0, y0 = int(x) - half_size, int(y) - half_size
+    window = np.full((size, size) + image.shape[2:], fill_value, dtype=image.dtype)
+    # intersection with the image
+    r0, r1 = max(y0, 0), min(y0 + size, rows)
+    c0, c1 = max(x0, 0), min(x0 + size, cols)
+    if r0 < r1 and c0 < c1:
+        window[r0 - y0:r1 - y0, c0 - x0:c1 - x0] = image[r0:r1, c0:c1]
+    return window, np.array([x0, y0])
+
+
+def insert_window(image, window, offset):
+    """
+    Copy `window` to `image` at `offset` (x, y) of its top-left corner, the part outside the image is skipped.
+    Returns `image`.
+    """
+    rows, cols = image.shape[:2]
+    x0, y0 = offset
+    r0, r1 = max(y0, 0), min(y0 + window.shape[0], rows)
+    c0, c1 = max(x0, 0), min(x0 + window.shape[1], cols)
+    if r0 < r1 and c0 < c1:
+        image[r0:r1, c0:c1] = window[r0 - y0:r1 - y0, c0 - x0:c1 - x0]
+    return image
+
+
 def gen_potential(points, image_shape, kernel):
     """
     Generate vector field for give `points` of size `image_shape` using kernel function `kernel` as potential.
@@ -106,3 +145,52 @@ def gen_potential(points, image_shape, kernel):
 
     return branching_potential, (f_br_x, f_br_y), branching_mask
 
+
+def gen_potential_local(points, image_shape, kernel, margin=2):
+    """
+    Same as `gen_potential`, but the potential, its mask and forces are computed only in the bounding window
+    of the kernels stamped at `points` (extended by `margin` pixels, so the forces at its border are exact).
+    Returns potential, (f_x, f_y), mask and offset (x, y) of the window in the image of size `image_shape`.
+    """
+    rows, cols = image_shape[:2]
+    kernel_rows, kernel_cols = kernel.shape
+
+    points_x = points[:, 0].astype(np.int64)
+    points_y = points[:, 1].astype(np.int64)
+
+    # Find bounding window of the stamped kernels
+    if len(points_x) > 0:
+        x0, x1 = points_x.min() - kernel_cols // 2 - margin, points_x.max() + kernel_cols // 2 + margin + 1
+        y0, y1 = points_y.min() - kernel_rows // 2 - margin, points_y.max() + kernel_rows // 2 + margin + 1
+    else:
+        x0, x1, y0, y1 = 0, 1, 0, 1
+
+    x0, y0 = min(max(x0, 0), cols - 1), min(max(y0, 0), rows - 1)
+    x1, y1 = max(min(x1, cols), x0 + 1), max(min(y1, rows), y0 + 1)
+
+    # Generate branching potential in the window
+    branching_potential, branching_mask = fill_pattern_coords(points_x - x0, points_y - y0, kernel,
+                                                              int(x1 - x0), int(y1 - y0))
+
+    # Find attraction forces from potential
+    f_br_x = filters.sobel_v(branching_potential)
+    f_br_y = filters.sobel_h(branching_potential)
+
+    return branching_potential, (f_br_x, f_br_y), branching_mask, np.array([x0, y0])
+
+
+def gen_frame_potentials(branching_coords, frames, image_shape, kernel):
+    """
+    Generate branching potentials of all branching points on `frames` using `gen_potential`.
+    Returns stacks of potentials, forces along x and y and masks (one image per frame).
+    """
+    frame_n = len(frames)
+    potentials = np.zeros((frame_n,) + tuple(image_shape), dtype=np.double)
+    forces_x = np.zeros_like(potentials)
+    forces_y = np.zeros_like(potentials)
+    masks = np.zeros((frame_n,) + tuple(image_shape), dtype=np.int64)
+
+    for i, frame_i in enumerate(frames):
+        potentials[i], (forces_x[i], forces_y[i]), masks[i] = gen_potential(branching_coords[frame_i], image_shape, kernel)
+
+    return potentials, forces_x, forces_y, masks
@@ -142,94 +142,227 @@ void sample_vector_field(double *gvf_x, double *gvf_y, int width, int height, do
 }
 
 
-void sample_vector_field_xy(double *gvf_x, double *gvf_y, int width, int height, double *points, int point_n, double *result) {
+template <typename T>
+inline void sample_point_xy(T *gvf_x, T *gvf_y, int width, int height, double x, double y, double *result) {
 
     Quadrant qx, qy;
 
+    int xi = int(x), yi = int(y);
+
+    // Skip point
+    if (xi < 0 || yi < 0 || xi >= width || yi >= height)
+        return;
+
+    int i00 = map_xy(xi, yi, width);
+    int i01 = map_xy(xi, yi+1, width);
+    int i10 = map_xy(xi+1, yi, width);
+    int i11 = map_xy(xi+1, yi+1, width);
+
+    // Select Quadrant
+    if (xi == width - 1 && yi == height - 1) {
+        qx = Quadrant(gvf_x[i00], 0.0, 0.0, 0.0);
+        qy = Quadrant(gvf_y[i00], 0.0, 0.0, 0.0);
+    } else if (xi == width - 1) {
+        qx = Quadrant(gvf_x[i00], 0.0, gvf_x[i01], 0.0);
+        qy = Quadrant(gvf_y[i00], 0.0, gvf_y[i01], 0.0);
+    } else if (yi == height - 1) {
+        qx = Quadrant(gvf_x[i00], gvf_x[i10], 0.0, 0.0);
+        qy = Quadrant(gvf_y[i00], gvf_y[i10], 0.0, 0.0);
+    } else {
+        qx = Quadrant(gvf_x[i00], gvf_x[i10], gvf_x[i01], gvf_x[i11]);
+        qy = Quadrant(gvf_y[i00], gvf_y[i10], gvf_y[i01], gvf_y[i11]);
+    }
+
+    // Interpolate
+    double residual_x = x - xi, residual_y = y - yi;
+    result[0] = bilinear_interpolation(qx, residual_x, residual_y);
+    result[1] = bilinear_interpolation(qy, residual_x, residual_y);
+}
+
+
+template <typename T>
+void sample_vector_field_xy(T *gvf_x, T *gvf_y, int width, int height, double *points, int point_n, double *result) {
+
     for (size_t i = 0; i < point_n; ++i) {
-        size_t px = i * 2, py = i * 2 + 1;
+        sample_point_xy(gvf_x, gvf_y, width, height, points[i * 2], points[i * 2 + 1], result + i * 2);
+    }
 
-        double x = points[px], y = points[py];
-        int xi = int(x), yi = int(y);
+}
 
-        // Skip point
-        if (xi < 0 || yi < 0 || xi >= width || yi >= height)
-            continue;
 
-        int i00 = map_xy(xi, yi, width);
-        int i01 = map_xy(xi, yi+1, width);
-        int i10 = map_xy(xi+1, yi, width);
-        int i11 = map_xy(xi+1, yi+1, width);
+template void sample_vector_field_xy<float>(float*, float*, int, int, double*, int, double*);
+template void sample_vector_field_xy<double>(double*, double*, int, int, double*, int, double*);
 
-        // Select Quadrant
-        if (xi == width - 1 && yi == height - 1) {
-            qx = Quadrant(gvf_x[i00], 0.0, 0.0, 0.0);
-            qy = Quadrant(gvf_y[i00], 0.0, 0.0, 0.0);
-        } else if (xi == width - 1) {
-            qx = Quadrant(gvf_x[i00], 0.0, gvf_x[i01], 0.0);
-            qy = Quadrant(gvf_y[i00], 0.0, gvf_y[i01], 0.0);
-        } else if (yi == height - 1) {
-            qx = Quadrant(gvf_x[i00], gvf_x[i10], 0.0, 0.0);
-            qy = Quadrant(gvf_y[i00], gvf_y[i10], 0.0, 0.0);
-        } else {
-            qx = Quadrant(gvf_x[i00], gvf_x[i10], gvf_x[i01], gvf_x[i11]);
-            qy = Quadrant(gvf_y[i00], gvf_y[i10], gvf_y[i01], gvf_y[i11]);
-        }
 
-        // Interpolate
-        double residual_x = x - xi, residual_y = y - yi;
-        result[px] = bilinear_interpolation(qx, residual_x, residual_y);
-        result[py] = bilinear_interpolation(qy, residual_x, residual_y);
+// Number of entries of the decoding table per unit of the angle byte
+#define DECODE_TABLE_STEPS 64
+
+
+// Table of cos/sin of the encoded angle (2 * a / 255 - 1) * pi on the uniform grid of a in [0, 255]
+class DecodeTable {
+public:
+    std::vector<double> cos_values, sin_values;
+
+    DecodeTable() {
+        size_t size = 255 * DECODE_TABLE_STEPS + 2;
+        cos_values.resize(size);
+        sin_values.resize(size);
+        for (size_t i = 0; i < size; ++i) {
+            double angle = (2.0 * i / (255.0 * DECODE_TABLE_STEPS) - 1.0) * M_PI;
+            cos_values[i] = cos(angle);
+            sin_values[i] = sin(angle);
+        }
     }
+};
 
-    //return result;
+
+// Decoding table is built once per process (on the first use)
+const DecodeTable& decode_table() {
+    static DecodeTable table;
+    return table;
+}
+
+
+// Decode x, y values with linear interpolation in the `table` (or with cos/sin if it is NULL)
+inline void decode_xy(double m, double a, const DecodeTable *table, double *result) {
+    if (table != NULL && a >= 0.0 && a <= 255.0) {
+        double t = a * DECODE_TABLE_STEPS;
+        int k = int(t);
+        double r = t - k;
+        result[0] = m * (table->cos_values[k] + r * (table->cos_values[k + 1] - table->cos_values[k])) / 255.0;
+        result[1] = m * (table->sin_values[k] + r * (table->sin_values[k + 1] - table->sin_values[k])) / 255.0;
+    } else {
+        result[0] = decode_x(m, a);
+        result[1] = decode_y(m, a);
+    }
 }
 
 
-void sample_vector_field_ra(unsigned char *gvf_m, unsigned char *gvf_a, int width, int height, double *points, int point_n, double *result) {
+inline void sample_point_ra(unsigned char *gvf_m, unsigned char *gvf_a, int width, int height, double x, double y,
+                            const DecodeTable *table, double *result) {
 
     Quadrant qm, qa;
 
+    int xi = int(x), yi = int(y);
+
+    // Skip point
+    if (xi < 0 || yi < 0 || xi >= width || yi >= height)
+        return;
+
+    int i00 = map_xy(xi, yi, width);
+    int i01 = map_xy(xi, yi+1, width);
+    int i10 = map_xy(xi+1, yi, width);
+    int i11 = map_xy(xi+1, yi+1, width);
+
+    // Select Quadrant
+    if (xi == width - 1 && yi == height - 1) {
+        qm = Quadrant(gvf_m[i00], 0.0, 0.0, 0.0);
+        qa = Quadrant(gvf_a[i00], 0.0, 0.0, 0.0);
+    } else if (xi == width - 1) {
+        qm = Quadrant(gvf_m[i00], 0.0, gvf_m[i01], 0.0);
+        qa = Quadrant(gvf_a[i00], 0.0, gvf_a[i01], 0.0);
+    } else if (yi == height - 1) {
+        qm = Quadrant(gvf_m[i00], gvf_m[i10], 0.0, 0.0);
+        qa = Quadrant(gvf_a[i00], gvf_a[i10], 0.0, 0.0);
+    } else {
+        qm = Quadrant(gvf_m[i00], gvf_m[i10], gvf_m[i01], gvf_m[i11]);
+        qa = Quadrant(gvf_a[i00], gvf_a[i10], gvf_a[i01], gvf_a[i11]);
+    }
+
+    // Interpolate
+    double residual_x = x - xi, residual_y = y - yi;
+    double m = bilinear_interpolation(qm, residual_x, residual_y);
+    double a = bilinear_interpolation(qa, residual_x, residual_y);
+
+    // Decode x, y values
+    decode_xy(m, a, table, result);
+}
+
+
+void sample_vector_field_ra(unsigned char *gvf_m, unsigned char *gvf_a, int width, int height, double *points, int point_n, double *result, bool exact) {
+
+    const DecodeTable *table = exact ? NULL : &decode_table();
+
     for (size_t i = 0; i < point_n; ++i) {
-        size_t px = i * 2, py = i * 2 + 1;
+        sample_point_ra(gvf_m, gvf_a, width, height, points[i * 2], points[i * 2 + 1], table, result + i * 2);
+    }
 
-        double x = points[px], y = points[py];
-        int xi = int(x), yi = int(y);
+}
 
-        // Skip point
-        if (xi < 0 || yi < 0 || xi >= width || yi >= height)
-            continue;
 
-        int i00 = map_xy(xi, yi, width);
-        int i01 = map_xy(xi, yi+1, width);
-        int i10 = map_xy(xi+1, yi, width);
-        int i11 = map_xy(xi+1, yi+1, width);
+// Sample points of many snakes in one call: the i-th point is sampled at (scale * x, scale * y) on the frame
+// `frames[i]` of the stacked fields of size width x height (on the first frame if `frames` is NULL)
+template <typename T>
+void sample_vector_field_xy_stack(T *gvf_x, T *gvf_y, int width, int height, long long *frames, double *points, int point_n, double scale, double *result) {
 
-        // Select Quadrant
-        if (xi == width - 1 && yi == height - 1) {
-            qm = Quadrant(gvf_m[i00], 0.0, 0.0, 0.0);
-            qa = Quadrant(gvf_a[i00], 0.0, 0.0, 0.0);
-        } else if (xi == width - 1) {
-            qm = Quadrant(gvf_m[i00], 0.0, gvf_m[i01], 0.0);
-            qa = Quadrant(gvf_a[i00], 0.0, gvf_a[i01], 0.0);
-        } else if (yi == height - 1) {
-            qm = Quadrant(gvf_m[i00], gvf_m[i10], 0.0, 0.0);
-            qa = Quadrant(gvf_a[i00], gvf_a[i10], 0.0, 0.0);
-        } else {
-            qm = Quadrant(gvf_m[i00], gvf_m[i10], gvf_m[i01], gvf_m[i11]);
-            qa = Quadrant(gvf_a[i00], gvf_a[i10], gvf_a[i01], gvf_a[i11]);
-        }
+    size_t frame_size = size_t(width) * height;
+
+    for (size_t i = 0; i < point_n; ++i) {
+        size_t offset = frames != NULL ? frames[i] * frame_size : 0;
+        sample_point_xy(gvf_x + offset, gvf_y + offset, width, height, scale * points[i * 2], scale * points[i * 2 + 1],
+                        result + i * 2);
+    }
+
+}
+
+
+template void sample_vector_field_xy_stack<float>(float*, float*, int, int, long long*, double*, int, double, double*);
+template void sample_vector_field_xy_stack<double>(double*, double*, int, int, long long*, double*, int, double, double*);
 
-        // Interpolate
-        double residual_x = x - xi, residual_y = y - yi;
-        double m = bilinear_interpolation(qm, residual_x, residual_y);
-        double a = bilinear_interpolation(qa, residual_x, residual_y);
 
-        // Decode x, y values
-        result[px] = decode_x(m, a);
-        result[py] = decode_y(m, a);
+void sample_vector_field_ra_stack(unsigned char *gvf_m, unsigned char *gvf_a, int width, int height, long long *frames, double *points, int point_n, double scale, bool exact, double *result) {
+
+    const DecodeTable *table = exact ? NULL : &decode_table();
+    size_t frame_size = size_t(width) * height;
+
+    for (size_t i = 0; i < point_n; ++i) {
+        size_t offset = frames != NULL ? frames[i] * frame_size : 0;
+        sample_point_ra(gvf_m + offset, gvf_a + offset, width, height, scale * points[i * 2], scale * points[i * 2 + 1],
+                        table, result + i * 2);
+    }
+
+}
+
+
+template <typename T>
+inline double sample_point(T *field, int width, int height, double x, double y, bool interpolate) {
+
+    // Skip point (the same as int(x) < 0 || int(x) >= width, but also for NaN and overflowing values)
+    if (!(x > -1.0 && y > -1.0 && x < width && y < height))
+        return 0.0;
+
+    int xi = int(x), yi = int(y);
+    int i00 = map_xy(xi, yi, width);
+
+    if (!interpolate)
+        return double(field[i00]);
+
+    // Select Quadrant (values outside the field are zeros)
+    bool has_x1 = xi < width - 1, has_y1 = yi < height - 1;
+    Quadrant q(field[i00],
+               has_x1 ? double(field[i00 + 1]) : 0.0,
+               has_y1 ? double(field[i00 + width]) : 0.0,
+               has_x1 && has_y1 ? double(field[i00 + width + 1]) : 0.0);
+
+    // Interpolate
+    return bilinear_interpolation(q, x - xi, y - yi);
+}
+
+
+template <typename T>
+void sample_scalar_field(T *field, int width, int height, double *points, int point_n, bool interpolate, double *result) {
+
+    for (size_t i = 0; i < point_n; ++i) {
+        result[i] = sample_point(field, width, height, points[i * 2], points[i * 2 + 1], interpolate);
     }
 
 }
 
 
+template void sample_scalar_field<unsigned char>(unsigned char*, int, int, double*, int, bool, double*);
+template void sample_scalar_field<unsigned short>(unsigned short*, int, int, double*, int, bool, double*);
+template void sample_scalar_field<int>(int*, int, int, double*, int, bool, double*);
+template void sample_scalar_field<long>(long*, int, int, double*, int, bool, double*);
+template void sample_scalar_field<long long>(long long*, int, int, double*, int, bool, double*);
+template void sample_scalar_field<float>(float*, int, int, double*, int, bool, double*);
+template void sample_scalar_field<double>(double*, int, int, double*, int, bool, double*);
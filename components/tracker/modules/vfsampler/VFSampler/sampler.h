@@ -10,7 +10,16 @@
 #define sampler_h
 
 
-void sample_vector_field_xy(double *gvf_x, double *gvf_y, int width, int height, double *points, int point_n, double *result);
-void sample_vector_field_ra(unsigned char *gvf_m, unsigned char *gvf_a, int width, int height, double *points, int point_n, double *result);
+template <typename T>
+void sample_vector_field_xy(T *gvf_x, T *gvf_y, int width, int height, double *points, int point_n, double *result);
+void sample_vector_field_ra(unsigned char *gvf_m, unsigned char *gvf_a, int width, int height, double *points, int point_n, double *result, bool exact = false);
+
+// Stacked fields of several frames (frames is NULL for a single frame), points are scaled by `scale`
+template <typename T>
+void sample_vector_field_xy_stack(T *gvf_x, T *gvf_y, int width, int height, long long *frames, double *points, int point_n, double scale, double *result);
+void sample_vector_field_ra_stack(unsigned char *gvf_m, unsigned char *gvf_a, int width, int height, long long *frames, double *points, int point_n, double scale, bool exact, double *result);
+
+template <typename T>
+void sample_scalar_field(T *field, int width, int height, double *points, int point_n, bool interpolate, double *result);
 
 #endif /* sampler_h */
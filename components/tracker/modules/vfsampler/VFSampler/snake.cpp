@@ -0,0 +1,308 @@
+//
+//  snake.cpp
+//  VFSampler
+//
+
+#include "snake.h"
+#include "sampler.h"
+#include <cmath>
+#include <cstring>
+#include <chrono>
+#include <vector>
+
+
+// Solve U^T U x = b in place for the column `b` with the stride `stride`, where U is the upper banded Cholesky
+// factor in the LAPACK storage (as returned by scipy.linalg.cholesky_banded): U[j - k, j] = factor[(bands_n - k) * n + j]
+void solve_banded(double *factor, int bands_n, int n, double *b, int stride) {
+
+    double *diagonal = factor + bands_n * n;
+
+    // Forward substitution U^T y = b
+    for (int j = 0; j < n; ++j) {
+        double s = b[j * stride];
+        for (int k = 1; k <= bands_n && k <= j; ++k)
+            s -= factor[(bands_n - k) * n + j] * b[(j - k) * stride];
+        b[j * stride] = s / diagonal[j];
+    }
+
+    // Backward substitution U x = y
+    for (int j = n - 1; j >= 0; --j) {
+        double s = b[j * stride];
+        for (int k = 1; k <= bands_n && j + k < n; ++k)
+            s -= factor[(bands_n - k) * n + j + k] * b[(j + k) * stride];
+        b[j * stride] = s / diagonal[j];
+    }
+
+}
+
+
+// Linear reparametrization of the contour `points` of `point_n` points by `result_n` points uniformly distributed
+// by arc length (the same as uniform_contour_reparametrization_n of parametrize.py), `length` is a buffer of
+// `point_n` values. Returns the step of the new contour.
+double reparametrize_contour(double *points, int point_n, double *length, double *result, int result_n) {
+
+    // Cumulative length of the contour
+    length[0] = 0.0;
+    for (int i = 1; i < point_n; ++i) {
+        double dx = points[i * 2] - points[(i - 1) * 2], dy = points[i * 2 + 1] - points[(i - 1) * 2 + 1];
+        length[i] = length[i - 1] + sqrt(dx * dx + dy * dy);
+    }
+
+    double total_length = length[point_n - 1];
+    double step = result_n > 1 ? total_length / (result_n - 1) : 0.0;
+
+    // Interpolate at uniform parameters (segments are found as in scipy.interpolate.interp1d)
+    int hi = 1;
+    for (int i = 0; i < result_n; ++i) {
+        double t = (i > 0 && i == result_n - 1) ? total_length : i * step;
+        while (hi < point_n - 1 && length[hi] < t)
+            ++hi;
+        int lo = hi - 1;
+        double dt = t - length[lo], dl = length[hi] - length[lo];
+        result[i * 2] = (points[hi * 2] - points[lo * 2]) / dl * dt + points[lo * 2];
+        result[i * 2 + 1] = (points[hi * 2 + 1] - points[lo * 2 + 1]) / dl * dt + points[lo * 2 + 1];
+    }
+
+    return step;
+}
+
+
+// Constraint force at the endpoint `p0` of the snake with the neighbour point `p1` (see constraint_forces of snakes.py)
+void endpoint_force(double *p0, double *p1, double *stretching, int width, int height, const VectorField &br,
+                    double b_mult, double *force) {
+
+    // Unit tangent vector
+    double dx = p0[0] - p1[0], dy = p0[1] - p1[1];
+    double norm = sqrt(dx * dx + dy * dy);
+
+    // Attraction force of the branching potential
+    double br_point[2] = {p0[0] - br.offset_x, p0[1] - br.offset_y}, br_grad[2] = {0.0, 0.0};
+    sample_vector_field_xy(br.x, br.y, br.width, br.height, br_point, 1, br_grad);
+
+    // Stretching force
+    double stretching_val = 0.0;
+    sample_scalar_field(stretching, width, height, p0, 1, true, &stretching_val);
+
+    force[0] = b_mult * br_grad[0] + stretching_val * (dx / norm);
+    force[1] = b_mult * br_grad[1] + stretching_val * (dy / norm);
+
+}
+
+
+// Add time elapsed since `start` to `stage_times[stage]` and restart it (if the iteration is timed)
+inline void lap(double *stage_times, int stage, std::chrono::steady_clock::time_point &start) {
+    if (stage_times == NULL)
+        return;
+    std::chrono::steady_clock::time_point now = std::chrono::steady_clock::now();
+    stage_times[stage] += std::chrono::duration<double>(now - start).count();
+    start = now;
+}
+
+
+// Evolve snake `points` (updated in place) until it converges or `iter_n` iterations are made, the same as
+// Tracker.evolve_snake of track.py. Snake of the iteration i is written to `trajectory[i]` and to the ring buffer
+// `history[(i - 1) % history_size]` (if they are not NULL). `buffer` has to keep 5 * point_n values.
+// Returns number of iterations made.
+int evolve_snake(double *points, int point_n,
+                 const GradientField &gvf,
+                 double *stretching, int width, int height,
+                 const VectorField &br0, const VectorField &br1,
+                 double *factor, int bands_n, double dt, double b_mult, int iter_n, double motion_threshold,
+                 double *trajectory, double *history, int history_size, double *buffer, double *stage_times) {
+
+    size_t snake_size = point_n * 2;
+    double *next = buffer, *rhs = buffer + snake_size, *length = buffer + 2 * snake_size;
+    double force0[2], force1[2];
+
+    int iter_i = 0;
+    for (iter_i = 1; iter_i <= iter_n; ++iter_i) {
+
+        // Time the stages of this iteration (every PROFILE_STRIDE-th one only)
+        double *timed = stage_times != NULL && (iter_i - 1) % PROFILE_STRIDE == 0 ? stage_times : NULL;
+        std::chrono::steady_clock::time_point start;
+        if (timed != NULL) {
+            timed[TIMED_ITERATIONS] += 1.0;
+            start = std::chrono::steady_clock::now();
+        }
+
+        // Sample vector field (GVF is 2x upscaled or a level of its pyramid)
+        for (size_t i = 0; i < snake_size; ++i) {
+            next[i] = gvf.scale * points[i];
+            rhs[i] = 0.0;
+        }
+        if (gvf.x != NULL)
+            sample_vector_field_xy(gvf.x, gvf.y, gvf.width, gvf.height, next, point_n, rhs);
+        else
+            sample_vector_field_ra(gvf.m, gvf.a, gvf.width, gvf.height, next, point_n, rhs);
+        lap(timed, GVF_SAMPLING, start);
+
+        // Compute constraint forces at the endpoints
+        endpoint_force(points, points + 2, stretching, width, height, br0, b_mult, force0);
+        endpoint_force(points + snake_size - 2, points + snake_size - 4, stretching, width, height, br1, b_mult, force1);
+        rhs[0] += force0[0];
+        rhs[1] += force0[1];
+        rhs[snake_size - 2] += force1[0];
+        rhs[snake_size - 1] += force1[1];
+        lap(timed, CONSTRAINT_FORCES, start);
+
+        // Semi-implicit step
+        for (size_t i = 0; i < snake_size; ++i)
+            rhs[i] = points[i] + dt * rhs[i];
+        solve_banded(factor, bands_n, point_n, rhs, 2);
+        solve_banded(factor, bands_n, point_n, rhs + 1, 2);
+        lap(timed, LINEAR_SOLVE, start);
+
+        reparametrize_contour(rhs, point_n, length, next, point_n);
+        lap(timed, REPARAMETRIZATION, start);
+
+        // Track results
+        if (trajectory != NULL)
+            memcpy(trajectory + iter_i * snake_size, next, snake_size * sizeof(double));
+        if (history != NULL)
+            memcpy(history + ((iter_i - 1) % history_size) * snake_size, next, snake_size * sizeof(double));
+
+        // Quantify the motion of the snake
+        double ds = 0.0;
+        for (int i = 0; i < point_n; ++i) {
+            double dx = next[i * 2] - points[i * 2], dy = next[i * 2 + 1] - points[i * 2 + 1];
+            ds += sqrt(dx * dx + dy * dy);
+        }
+        ds /= point_n;
+
+        memcpy(points, next, snake_size * sizeof(double));
+
+        if (ds < motion_threshold)
+            break;
+    }
+
+    // Number of iterations (the same as the last value of the loop variable in Python)
+    return iter_i > iter_n ? iter_n : iter_i;
+}
+
+
+// Evolve snakes of the same frame together, every snake the same as by evolve_snake. Points of the active snakes are
+// packed one after another: every iteration samples the GVF at the points of all of them in one call, then computes
+// the constraint forces, the banded solves and the reparametrizations of all snakes. A snake is frozen as soon as it
+// converges or makes its `iter_n` iterations. Iterations are timed as in evolve_snake. `buffer` has to keep
+// 6 * P + N values, where P is the total number of points and N is the number of points of the longest snake.
+// Number of iterations made by every snake is written to `iterations`, returns their sum.
+int evolve_snakes(BatchSnake *snakes, int snake_n,
+                  const GradientField &gvf,
+                  double *stretching, int width, int height,
+                  double dt, double b_mult, double motion_threshold,
+                  int history_size, double *buffer, int *iterations, double *stage_times) {
+
+    size_t total_size = 0;
+    for (int k = 0; k < snake_n; ++k)
+        total_size += snakes[k].point_n * 2;
+    double *curr = buffer, *rhs = buffer + total_size, *next = buffer + 2 * total_size, *length = buffer + 3 * total_size;
+    double force0[2], force1[2];
+
+    // Pack active snakes: indices of the snakes and positions of their points
+    std::vector<int> active;
+    std::vector<size_t> starts;
+    size_t packed_size = 0;
+    for (int k = 0; k < snake_n; ++k) {
+        iterations[k] = 0;
+        if (snakes[k].iter_n <= 0)
+            continue;
+        active.push_back(k);
+        starts.push_back(packed_size);
+        memcpy(curr + packed_size, snakes[k].points, snakes[k].point_n * 2 * sizeof(double));
+        packed_size += snakes[k].point_n * 2;
+    }
+
+    int total_iterations = 0;
+    for (int iter_i = 1; !active.empty(); ++iter_i) {
+
+        // Time the stages of this iteration (every PROFILE_STRIDE-th one only)
+        double *timed = stage_times != NULL && (iter_i - 1) % PROFILE_STRIDE == 0 ? stage_times : NULL;
+        std::chrono::steady_clock::time_point start;
+        if (timed != NULL) {
+            timed[TIMED_ITERATIONS] += 1.0;
+            start = std::chrono::steady_clock::now();
+        }
+
+        // Sample vector field at the points of all active snakes (GVF is 2x upscaled or a level of its pyramid)
+        for (size_t i = 0; i < packed_size; ++i)
+            rhs[i] = 0.0;
+        if (gvf.x != NULL)
+            sample_vector_field_xy_stack(gvf.x, gvf.y, gvf.width, gvf.height, NULL, curr, int(packed_size / 2),
+                                         gvf.scale, rhs);
+        else
+            sample_vector_field_ra_stack(gvf.m, gvf.a, gvf.width, gvf.height, NULL, curr, int(packed_size / 2),
+                                         gvf.scale, false, rhs);
+        lap(timed, GVF_SAMPLING, start);
+
+        // Compute constraint forces at the endpoints of every snake
+        for (size_t j = 0; j < active.size(); ++j) {
+            const BatchSnake &snake = snakes[active[j]];
+            size_t snake_size = snake.point_n * 2;
+            double *points = curr + starts[j], *forces = rhs + starts[j];
+            endpoint_force(points, points + 2, stretching, width, height, snake.br0, b_mult, force0);
+            endpoint_force(points + snake_size - 2, points + snake_size - 4, stretching, width, height, snake.br1,
+                           b_mult, force1);
+            forces[0] += force0[0];
+            forces[1] += force0[1];
+            forces[snake_size - 2] += force1[0];
+            forces[snake_size - 1] += force1[1];
+        }
+        lap(timed, CONSTRAINT_FORCES, start);
+
+        // Semi-implicit step of every snake
+        for (size_t i = 0; i < packed_size; ++i)
+            rhs[i] = curr[i] + dt * rhs[i];
+        for (size_t j = 0; j < active.size(); ++j) {
+            const BatchSnake &snake = snakes[active[j]];
+            solve_banded(snake.factor, snake.bands_n, snake.point_n, rhs + starts[j], 2);
+            solve_banded(snake.factor, snake.bands_n, snake.point_n, rhs + starts[j] + 1, 2);
+        }
+        lap(timed, LINEAR_SOLVE, start);
+
+        for (size_t j = 0; j < active.size(); ++j) {
+            const BatchSnake &snake = snakes[active[j]];
+            reparametrize_contour(rhs + starts[j], snake.point_n, length, next + starts[j], snake.point_n);
+        }
+        lap(timed, REPARAMETRIZATION, start);
+
+        // Track results, freeze snakes that converge and pack the others
+        size_t kept = 0, kept_size = 0;
+        for (size_t j = 0; j < active.size(); ++j) {
+            const BatchSnake &snake = snakes[active[j]];
+            size_t snake_size = snake.point_n * 2;
+            double *points = curr + starts[j], *next_points = next + starts[j];
+
+            if (snake.trajectory != NULL)
+                memcpy(snake.trajectory + iter_i * snake_size, next_points, snake_size * sizeof(double));
+            if (snake.history != NULL)
+                memcpy(snake.history + ((iter_i - 1) % history_size) * snake_size, next_points,
+                       snake_size * sizeof(double));
+
+            // Quantify the motion of the snake
+            double ds = 0.0;
+            for (int i = 0; i < snake.point_n; ++i) {
+                double dx = next_points[i * 2] - points[i * 2], dy = next_points[i * 2 + 1] - points[i * 2 + 1];
+                ds += sqrt(dx * dx + dy * dy);
+            }
+            ds /= snake.point_n;
+            ++total_iterations;
+
+            if (ds < motion_threshold || iter_i >= snake.iter_n) {
+                memcpy(snake.points, next_points, snake_size * sizeof(double));
+                iterations[active[j]] = iter_i;
+            } else {
+                // Points of the snake move to its packed position (it does not overlap the following snakes)
+                memcpy(curr + kept_size, next_points, snake_size * sizeof(double));
+                active[kept] = active[j];
+                starts[kept] = kept_size;
+                ++kept;
+                kept_size += snake_size;
+            }
+        }
+        active.resize(kept);
+        starts.resize(kept);
+        packed_size = kept_size;
+    }
+
+    return total_iterations;
+}
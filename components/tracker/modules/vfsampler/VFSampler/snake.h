@@ -0,0 +1,62 @@
+//
+//  snake.h
+//  VFSampler
+//
+
+#ifndef snake_h
+#define snake_h
+
+
+// Vector field (x, y) of size width x height placed at (offset_x, offset_y) of the image
+struct VectorField {
+    double *x, *y;
+    int width, height;
+    double offset_x, offset_y;
+};
+
+
+// Gradient vector flow of size width x height, either encoded as magnitude and angle bytes (m, a)
+// or decoded to components (x, y), unused pointers are NULL. Point (x, y) of the image is sampled at
+// (scale * x, scale * y): 2 for the 2x upscaled GVF of the preprocessor, 2 / 2^l for the level l of its pyramid
+struct GradientField {
+    unsigned char *m, *a;
+    float *x, *y;
+    int width, height;
+    double scale;
+};
+
+
+double reparametrize_contour(double *points, int point_n, double *length, double *result, int result_n);
+
+// Stages of an iteration of evolve_snake timed in `stage_times`, the last value counts the timed iterations
+enum EvolutionStage { GVF_SAMPLING, CONSTRAINT_FORCES, LINEAR_SOLVE, REPARAMETRIZATION, TIMED_ITERATIONS };
+
+// Stages are timed on every PROFILE_STRIDE-th iteration only (starting from the first one)
+const int PROFILE_STRIDE = 16;
+
+int evolve_snake(double *points, int point_n,
+                 const GradientField &gvf,
+                 double *stretching, int width, int height,
+                 const VectorField &br0, const VectorField &br1,
+                 double *factor, int bands_n, double dt, double b_mult, int iter_n, double motion_threshold,
+                 double *trajectory, double *history, int history_size, double *buffer, double *stage_times);
+
+// Snake evolved by evolve_snakes: points (updated in place), branching forces at its endpoints, banded Cholesky factor
+// of its system, maximum number of iterations and buffers of its iterations (NULL if they are not recorded)
+struct BatchSnake {
+    double *points;
+    int point_n;
+    VectorField br0, br1;
+    double *factor;
+    int bands_n;
+    int iter_n;
+    double *trajectory, *history;
+};
+
+int evolve_snakes(BatchSnake *snakes, int snake_n,
+                  const GradientField &gvf,
+                  double *stretching, int width, int height,
+                  double dt, double b_mult, double motion_threshold,
+                  int history_size, double *buffer, int *iterations, double *stage_times);
+
+#endif /* snake_h */
@@ -0,0 +1,21 @@
+#
+# Copyright (C) Software Competence Center Hagenberg GmbH (SCCH)
+# All rights reserved.
+#
+# This document contains proprietary information belonging to SCCH.
+# Passing on and copying of this document, use and communication of its
+# contents is not permitted without prior written authorization.
+#
+
+# The native module is built from vfsampler.pyx and VFSampler/*.cpp by compile_all.sh (in the repository root),
+# a module built from older sources lacks functions used by the tracker
+try:
+    from . import vfsampler
+except ImportError as e:
+    raise ImportError("vfsampler extension is not built ({0}), run compile_all.sh".format(e))
+
+missing = [name for name in ['sample_vf', 'decode_vf', 'sample_sf', 'evolve_snake', 'evolve_snakes',
+                             'reparametrize_contour'] if not hasattr(vfsampler, name)]
+if len(missing) > 0:
+    raise ImportError("vfsampler extension is outdated (no {0}), rebuild it with compile_all.sh".format(
+        ", ".join(missing)))
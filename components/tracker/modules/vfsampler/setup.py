@@ -31,7 +31,7 @@ else:
     extra_args = []
 
 
-ext_modules = [Extension("vfsampler", ["vfsampler.pyx", "./VFSampler/sampler.cpp"],
+ext_modules = [Extension("vfsampler", ["vfsampler.pyx", "./VFSampler/sampler.cpp", "./VFSampler/snake.cpp"],
                          language='c++',
                          include_dirs=[numpy.get_include()],
                          extra_compile_args=extra_args,
@@ -0,0 +1,86 @@
+#
+# Copyright (C) Software Competence Center Hagenberg GmbH (SCCH)
+# All rights reserved.
+#
+# This document contains proprietary information belonging to SCCH.
+# Passing on and copying of this document, use and communication of its
+# contents is not permitted without prior written authorization.
+#
+
+
+import timeit
+import functools
+import numpy as np
+from vfsampler import decode_vf, decode_vf_stack
+
+import matplotlib.pyplot as plt
+
+
+def exact_decode_vf(gvf_m, gvf_a, points):
+    return decode_vf(gvf_m, gvf_a, points, True)
+
+
+def per_snake_decode_vf(gvf_m, gvf_a, snakes, frames):
+    return [decode_vf(gvf_m[frame_i], gvf_a[frame_i], 2.0 * snake) for snake, frame_i in zip(snakes, frames)]
+
+
+image_w, image_h, frame_n = 1024, 1024, 4
+
+gvf_m = (np.random.rand(frame_n, image_h, image_w) * 255).astype(np.uint8)
+gvf_a = (np.random.rand(frame_n, image_h, image_w) * 255).astype(np.uint8)
+
+points = np.hstack([np.random.rand(1000, 1) * (image_w - 1), np.random.rand(1000, 1) * (image_h - 1)])
+print "Error (L-infinity): ", np.abs(decode_vf(gvf_m[0], gvf_a[0], points) - exact_decode_vf(gvf_m[0], gvf_a[0], points)).max()
+
+
+points_nn = 2 ** np.arange(2, 14)
+exact_time = np.zeros_like(points_nn, dtype=np.float)
+table_time = np.zeros_like(points_nn, dtype=np.float)
+
+for i, points_n in enumerate(points_nn):
+    points = np.hstack([np.random.rand(points_n, 1) * (image_w - 1), np.random.rand(points_n, 1) * (image_h - 1)])
+
+    error = np.abs(decode_vf(gvf_m[0], gvf_a[0], points) - exact_decode_vf(gvf_m[0], gvf_a[0], points)).max()
+
+    exact_time[i] = timeit.Timer(functools.partial(exact_decode_vf, gvf_m[0], gvf_a[0], points)).timeit(100)
+    table_time[i] = timeit.Timer(functools.partial(decode_vf, gvf_m[0], gvf_a[0], points)).timeit(100)
+
+    print "Points_N: {0}, Exact_Time: {1}, Table_Time: {2}, Error: {3}".format(points_n, exact_time[i],
+                                                                               table_time[i], error)
+
+
+# Sampling of many snakes (on different frames) in one call
+snakes_nn = 2 ** np.arange(0, 8)
+per_snake_time = np.zeros_like(snakes_nn, dtype=np.float)
+stack_time = np.zeros_like(snakes_nn, dtype=np.float)
+
+for i, snakes_n in enumerate(snakes_nn):
+    snakes = [np.hstack([np.random.rand(50, 1) * (image_w / 2 - 1), np.random.rand(50, 1) * (image_h / 2 - 1)])
+              for _ in xrange(snakes_n)]
+    frames = np.random.randint(0, frame_n, snakes_n)
+    points = np.vstack(snakes)
+    point_frames = np.repeat(frames, 50).astype(np.int64)
+    out = np.empty_like(points)
+
+    error = np.abs(np.vstack(per_snake_decode_vf(gvf_m, gvf_a, snakes, frames)) -
+                   decode_vf_stack(gvf_m, gvf_a, points, point_frames, 2.0, False, out)).max()
+
+    per_snake_time[i] = timeit.Timer(functools.partial(per_snake_decode_vf, gvf_m, gvf_a, snakes, frames)).timeit(100)
+    stack_time[i] = timeit.Timer(functools.partial(decode_vf_stack, gvf_m, gvf_a, points, point_frames, 2.0, False,
+                                                   out)).timeit(100)
+
+    print "Snakes_N: {0}, Per_Snake_Time: {1}, Stack_Time: {2}, Error: {3}".format(snakes_n, per_snake_time[i],
+                                                                                   stack_time[i], error)
+
+
+plt.figure()
+plt.plot(points_nn, exact_time, 'o-', label="cos/sin")
+plt.plot(points_nn, table_time, 'o-', label="Table")
+plt.legend()
+
+plt.figure()
+plt.plot(snakes_nn, per_snake_time, 'o-', label="Per snake")
+plt.plot(snakes_nn, stack_time, 'o-', label="Stack")
+plt.legend()
+
+plt.show()
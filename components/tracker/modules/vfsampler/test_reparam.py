@@ -0,0 +1,104 @@
+#
+# Copyright (C) Software Competence Center Hagenberg GmbH (SCCH)
+# All rights reserved.
+#
+# This document contains proprietary information belonging to SCCH.
+# Passing on and copying of this document, use and communication of its
+# contents is not permitted without prior written authorization.
+#
+
+
+import sys
+sys.path.insert(0, "..")
+
+import timeit
+import functools
+import numpy as np
+from scipy import interpolate
+from vfsampler.vfsampler import reparametrize_contour
+
+import matplotlib.pyplot as plt
+
+from parametrize import uniform_contour_reparametrization_n, uniform_contour_reparametrization
+
+
+def python_reparametrization_n(x, y, point_n):
+    l = np.hstack([[0.0], np.cumsum(np.sqrt((x[1:] - x[:-1]) ** 2 + (y[1:] - y[:-1]) ** 2))]).ravel()
+    fx = interpolate.interp1d(l, x, kind="linear")
+    fy = interpolate.interp1d(l, y, kind="linear")
+    reparam_t = np.linspace(0.0, l[-1], point_n)
+    return fx(reparam_t), fy(reparam_t), reparam_t[1]
+
+
+def python_reparametrization(x, y, step=1.0, curve_kind="cubic"):
+    l = np.hstack([[0.0], np.cumsum(np.sqrt((x[1:] - x[:-1]) ** 2 + (y[1:] - y[:-1]) ** 2))]).ravel()
+    fx = interpolate.interp1d(l, x, kind=curve_kind)
+    fy = interpolate.interp1d(l, y, kind=curve_kind)
+    length = l[-1]
+    point_n = int(length / step)
+    reparam_t = np.linspace(0.0, length, point_n)
+    return fx(reparam_t), fy(reparam_t), length / point_n
+
+
+def random_contour(point_n):
+    t = np.linspace(0.0, 1.0, point_n)
+    x = 100.0 * t + np.random.rand(point_n) * 2.0
+    y = 20.0 * np.sin(5.0 * t) + np.random.rand(point_n) * 2.0
+    return x, y
+
+
+x = np.array([0.0, 1.0, 1.0, 3.0, 3.0])
+y = np.array([0.0, 0.0, 1.0, 1.0, 2.0])
+
+cpp_result = uniform_contour_reparametrization_n(x, y, 7)
+print "C++ result:"
+print np.dstack(cpp_result[:2])[0], cpp_result[2], "\n"
+
+python_result = python_reparametrization_n(x, y, 7)
+print "Python result:"
+print np.dstack(python_result[:2])[0], python_result[2], "\n"
+
+print "Error (L-infinity): ", np.abs(np.dstack(cpp_result[:2]) - np.dstack(python_result[:2])).max()
+
+for kind in ["linear", "slinear", "quadratic", "cubic"]:
+    x, y = random_contour(50)
+    error = np.abs(np.dstack(uniform_contour_reparametrization(x, y, 1.5, kind)[:2]) -
+                   np.dstack(python_reparametrization(x, y, 1.5, kind)[:2])).max()
+    print "Kind: {0}, Error (L-infinity): {1}".format(kind, error)
+
+
+points_nn = 2 ** np.arange(2, 12)
+python_time = np.zeros_like(points_nn, dtype=np.float)
+cpp_time = np.zeros_like(points_nn, dtype=np.float)
+inplace_time = np.zeros_like(points_nn, dtype=np.float)
+python_cubic_time = np.zeros_like(points_nn, dtype=np.float)
+cubic_time = np.zeros_like(points_nn, dtype=np.float)
+
+for i, points_n in enumerate(points_nn):
+    x, y = random_contour(points_n)
+    points = np.ascontiguousarray(np.dstack([x, y])[0])
+    out, buffer = np.empty_like(points), np.empty(points_n)
+
+    error = np.abs(np.dstack(python_reparametrization_n(x, y, points_n)[:2])[0] -
+                   reparametrize_contour(points, points_n, out, buffer)[0]).max()
+
+    python_time[i] = timeit.Timer(functools.partial(python_reparametrization_n, x, y, points_n)).timeit(100)
+    cpp_time[i] = timeit.Timer(functools.partial(uniform_contour_reparametrization_n, x, y, points_n)).timeit(100)
+    inplace_time[i] = timeit.Timer(functools.partial(reparametrize_contour, points, points_n, out, buffer)).timeit(100)
+    python_cubic_time[i] = timeit.Timer(functools.partial(python_reparametrization, x, y, 1.0)).timeit(100)
+    cubic_time[i] = timeit.Timer(functools.partial(uniform_contour_reparametrization, x, y, 1.0)).timeit(100)
+
+    print "Points_N: {0}, Python_Time: {1}, Cpp_Time: {2}, Cpp_Inplace_Time: {3}, Error: {4}".format(
+        points_n, python_time[i], cpp_time[i], inplace_time[i], error)
+    print "Points_N: {0}, Python_Cubic_Time: {1}, Cubic_Time: {2}".format(points_n, python_cubic_time[i], cubic_time[i])
+
+
+plt.figure()
+plt.plot(points_nn, python_time, 'o-', label="Python (linear)")
+plt.plot(points_nn, cpp_time, 'o-', label="C++ (linear)")
+plt.plot(points_nn, inplace_time, 'o-', label="C++ in-place (linear)")
+plt.plot(points_nn, python_cubic_time, 'o-', label="Python (cubic)")
+plt.plot(points_nn, cubic_time, 'o-', label="Spline (cubic)")
+plt.legend()
+
+plt.show()
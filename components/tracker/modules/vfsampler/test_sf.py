@@ -0,0 +1,84 @@
+#
+# Copyright (C) Software Competence Center Hagenberg GmbH (SCCH)
+# All rights reserved.
+#
+# This document contains proprietary information belonging to SCCH.
+# Passing on and copying of this document, use and communication of its
+# contents is not permitted without prior written authorization.
+#
+
+
+import sys
+sys.path.insert(0, "..")
+
+import timeit
+import functools
+import numpy as np
+from vfsampler.vfsampler import sample_sf as cpp_sample_sf
+from skimage.filters import gaussian
+from skimage.exposure import rescale_intensity
+
+import matplotlib.pyplot as plt
+
+from snakes import sample_sf_python as python_sample_sf
+
+image = np.array([
+    [0.0, 1.0, 1.0, 0.0],
+    [0.0, 2.0, 2.0, 0.0],
+    [0.0, 2.0, 2.0, 0.0],
+    [0.0, 1.0, 1.0, 0.0]
+])
+
+points = np.array([[0.5, 0.0], [0.5, 0.5], [1.5, 1.5], [0.5, 1.0], [3.5, 3.5], [-0.5, 1.0], [4.0, 1.0]])
+
+cpp_result = cpp_sample_sf(image, points)
+print "C++ result:"
+print cpp_result, "\n"
+
+python_result = python_sample_sf(image, points)
+print "Python result:"
+print python_result, "\n"
+
+print "Error (L-infinity): ", np.abs((cpp_result - python_result)).max()
+
+for dtype in [np.uint8, np.uint16, np.int32, np.int64, np.float32, np.float64, np.bool_]:
+    field = (image * 100).astype(dtype)
+    error = max(np.abs(cpp_sample_sf(field, points, interp).astype(np.double) -
+                       python_sample_sf(field, points, interp).astype(np.double)).max() for interp in [True, False])
+    print "Type: {0}, Error (L-infinity): {1}".format(np.dtype(dtype).name, error)
+
+image_w, image_h, points_n = 1024, 1024, 1000
+
+image = rescale_intensity(gaussian(np.random.rand(image_h, image_w) * 65535, 10.0))
+points = np.hstack([np.random.rand(points_n, 1) * (image_w - 1), np.random.rand(points_n, 1) * (image_h - 1)])
+
+sf_vis = plt.figure()
+ax = sf_vis.add_subplot(111)
+ax.plot(points[:,0], points[:,1], 'ko')
+ax.imshow(image)
+
+
+points_nn = 2 ** np.arange(2, 10)
+python_time = np.zeros_like(points_nn, dtype=np.float)
+cpp_time = np.zeros_like(points_nn, dtype=np.float)
+
+for i, points_n in enumerate(points_nn):
+    points = np.hstack([np.random.rand(points_n, 1) * (image_w - 1), np.random.rand(points_n, 1) * (image_h - 1)])
+
+    error = np.abs(python_sample_sf(image, points) - cpp_sample_sf(image, points)).max()
+
+    t_python = timeit.Timer(functools.partial(python_sample_sf, image, points))
+    python_time[i] = t_python.timeit(5)
+
+    t_cpp = timeit.Timer(functools.partial(cpp_sample_sf, image, points))
+    cpp_time[i] = t_cpp.timeit(5)
+
+    print "Points_N: {0}, Python_Time: {1}, Cpp_Time: {2}, Error: {3}".format(points_n, python_time[i], cpp_time[i], error)
+
+
+plt.figure()
+plt.plot(points_nn, python_time, 'o-', label="Python")
+plt.plot(points_nn, cpp_time, 'o-', label="C++")
+plt.legend()
+
+plt.show()
@@ -11,12 +11,56 @@
 #
 
 import cython
+from libcpp cimport bool
+from libcpp.vector cimport vector
 
 
 # Declare the prototype of the C++ function we are interested in calling
 cdef extern from "./VFSampler/sampler.h":
-    void sample_vector_field_xy(double *gvf_x, double *gvf_y, int width, int height, double *points, int points_n, double *result);
-    void sample_vector_field_ra(unsigned char *gvf_m, unsigned char *gvf_a, int width, int height, double *points, int point_n, double *result)
+    void sample_vector_field_xy[T](T *gvf_x, T *gvf_y, int width, int height, double *points, int points_n, double *result);
+    void sample_vector_field_ra(unsigned char *gvf_m, unsigned char *gvf_a, int width, int height, double *points, int point_n, double *result, bool exact)
+    void sample_vector_field_ra_stack(unsigned char *gvf_m, unsigned char *gvf_a, int width, int height, long long *frames, double *points, int point_n, double scale, bool exact, double *result)
+    void sample_scalar_field[T](T *field, int width, int height, double *points, int point_n, bool interpolate, double *result)
+
+cdef extern from "./VFSampler/snake.h":
+    cdef struct VectorField:
+        double *x
+        double *y
+        int width, height
+        double offset_x, offset_y
+
+    cdef struct GradientField:
+        unsigned char *m
+        unsigned char *a
+        float *x
+        float *y
+        int width, height
+        double scale
+
+    double c_reparametrize_contour "reparametrize_contour"(double *points, int point_n, double *length,
+                                                          double *result, int result_n) nogil
+
+    int c_evolve_snake "evolve_snake"(double *points, int point_n, const GradientField &gvf,
+                                      double *stretching, int width, int height,
+                                      const VectorField &br0, const VectorField &br1,
+                                      double *factor, int bands_n, double dt, double b_mult, int iter_n,
+                                      double motion_threshold, double *trajectory, double *history, int history_size,
+                                      double *buffer, double *stage_times) nogil
+
+    cdef struct BatchSnake:
+        double *points
+        int point_n
+        VectorField br0, br1
+        double *factor
+        int bands_n
+        int iter_n
+        double *trajectory
+        double *history
+
+    int c_evolve_snakes "evolve_snakes"(BatchSnake *snakes, int snake_n, const GradientField &gvf,
+                                        double *stretching, int width, int height,
+                                        double dt, double b_mult, double motion_threshold,
+                                        int history_size, double *buffer, int *iterations, double *stage_times) nogil
 
 
 # Import the Python-level symbols of numpy
@@ -26,10 +70,65 @@ import numpy as np
 cimport numpy as np
 
 
+cdef double* array_data(buffer, shape, name) except NULL:
+    """
+    Pointer to the data of C-contiguous double array `buffer` of the given shape
+    """
+    if not isinstance(buffer, np.ndarray) or buffer.dtype != np.double or not buffer.flags.c_contiguous \
+            or buffer.shape != shape:
+        raise ValueError("{0} has to be C-contiguous double array of shape {1}".format(name, shape))
+    return <double*> np.PyArray_DATA(<np.ndarray> buffer)
+
+
+cdef VectorField vector_field(force, offset, list arrays) except *:
+    """
+    Branching force (f_x, f_y) with the window placed at `offset` (x, y), its arrays are kept in `arrays`
+    """
+    cdef np.ndarray[double, ndim=2, mode="c"] f_x = np.ascontiguousarray(force[0], dtype=np.double)
+    cdef np.ndarray[double, ndim=2, mode="c"] f_y = np.ascontiguousarray(force[1], dtype=np.double)
+    arrays.extend([f_x, f_y])
+
+    cdef VectorField field
+    field.x, field.y = <double*> f_x.data, <double*> f_y.data
+    field.width, field.height = f_x.shape[1], f_x.shape[0]
+    field.offset_x, field.offset_y = offset[0], offset[1]
+    return field
+
+
+cdef GradientField gradient_field(gvf, double scale, list arrays) except *:
+    """
+    Gradient vector flow `gvf`: pair of uint8 (magnitude, angle) or float32 (x, y) images sampled at `scale` * points,
+    its arrays are kept in `arrays`
+    """
+    cdef np.ndarray gvf_0 = np.ascontiguousarray(gvf[0])
+    cdef np.ndarray gvf_1 = np.ascontiguousarray(gvf[1])
+    if gvf_0.dtype != gvf_1.dtype or gvf_0.dtype not in (np.uint8, np.float32) or gvf_0.ndim != 2 \
+            or gvf_0.shape[0] != gvf_1.shape[0] or gvf_0.shape[1] != gvf_1.shape[1]:
+        raise ValueError("gvf has to be a pair of uint8 (magnitude, angle) or float32 (x, y) images")
+    arrays.extend([gvf_0, gvf_1])
+
+    cdef GradientField field
+    field.m, field.a = <unsigned char*> NULL, <unsigned char*> NULL
+    field.x, field.y = <float*> NULL, <float*> NULL
+    field.width, field.height = gvf_0.shape[1], gvf_0.shape[0]
+    field.scale = scale
+    if gvf_0.dtype == np.uint8:
+        field.m, field.a = <unsigned char*> gvf_0.data, <unsigned char*> gvf_1.data
+    else:
+        field.x, field.y = <float*> gvf_0.data, <float*> gvf_1.data
+    return field
+
+
+# Types of decoded vector fields
+ctypedef fused vf_t:
+    np.float32_t
+    np.float64_t
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def sample_vf(np.ndarray[double, ndim=2, mode="c"] gvf_x not None,
-              np.ndarray[double, ndim=2, mode="c"] gvf_y not None,
+def sample_vf(np.ndarray[vf_t, ndim=2, mode="c"] gvf_x not None,
+              np.ndarray[vf_t, ndim=2, mode="c"] gvf_y not None,
               np.ndarray[double, ndim=2, mode="c"] points not None):
 
     width, height = gvf_x.shape[1], gvf_x.shape[0]
@@ -38,8 +137,8 @@ def sample_vf(np.ndarray[double, ndim=2, mode="c"] gvf_x not None,
     cpdef np.ndarray[double, ndim=2, mode="c"] result = np.zeros_like(points)
 
     cdef double* points_ptr = <double*> points.data;
-    cdef double* gvf_x_ptr = <double*> gvf_x.data;
-    cdef double* gvf_y_ptr = <double*> gvf_y.data;
+    cdef vf_t* gvf_x_ptr = <vf_t*> gvf_x.data;
+    cdef vf_t* gvf_y_ptr = <vf_t*> gvf_y.data;
     #cdef double* result_ptr = <double*> result.data;
 
     # Call the C function
@@ -52,7 +151,12 @@ def sample_vf(np.ndarray[double, ndim=2, mode="c"] gvf_x not None,
 @cython.wraparound(False)
 def decode_vf(np.ndarray[np.uint8_t, ndim=2, mode="c"] gvf_magnitude not None,
               np.ndarray[np.uint8_t, ndim=2, mode="c"] gvf_angle not None,
-              np.ndarray[double, ndim=2, mode="c"] points not None):
+              np.ndarray[double, ndim=2, mode="c"] points not None,
+              bool exact=False):
+    """
+    Sample GVF encoded as magnitude and angle at `points`, the angle is decoded with the table of cos/sin
+    built once per process (relative error below 1e-7) or with cos/sin if `exact` is True
+    """
 
     width, height = gvf_magnitude.shape[1], gvf_magnitude.shape[0]
     points_n = points.shape[0]
@@ -64,7 +168,272 @@ def decode_vf(np.ndarray[np.uint8_t, ndim=2, mode="c"] gvf_magnitude not None,
     cdef np.uint8_t* gvf_a_ptr = <np.uint8_t*> gvf_angle.data;
 
     # Call the C function
-    sample_vector_field_ra(gvf_m_ptr, gvf_a_ptr, width, height, points_ptr, points_n, <double*>result.data)
+    sample_vector_field_ra(gvf_m_ptr, gvf_a_ptr, width, height, points_ptr, points_n, <double*>result.data, exact)
 
     return result
 
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def decode_vf_stack(np.ndarray[np.uint8_t, ndim=3, mode="c"] gvf_magnitude not None,
+                    np.ndarray[np.uint8_t, ndim=3, mode="c"] gvf_angle not None,
+                    np.ndarray[double, ndim=2, mode="c"] points not None,
+                    np.ndarray[long long, ndim=1, mode="c"] frames not None,
+                    double scale=1.0, bool exact=False, out=None):
+    """
+    Sample points of many snakes in one call: the i-th point is scaled by `scale` and sampled on the frame
+    `frames[i]` of the stacks of GVF magnitude and angle (see `decode_vf`).
+    The result is written to `out` of shape (N, 2) (allocated if None), points outside of frames are zeros.
+    """
+    frame_n, height, width = gvf_magnitude.shape[0], gvf_magnitude.shape[1], gvf_magnitude.shape[2]
+    points_n = points.shape[0]
+
+    if frames.shape[0] != points_n:
+        raise ValueError("frames has to contain a frame index for every point")
+    if points_n > 0 and (frames.min() < 0 or frames.max() >= frame_n):
+        raise ValueError("frame index out of range")
+
+    if out is None:
+        out = np.zeros((points_n, 2), dtype=np.double)
+    else:
+        out[...] = 0.0
+    cdef double *out_ptr = array_data(out, (points_n, 2), "out")
+
+    # Call the C function
+    sample_vector_field_ra_stack(<np.uint8_t*> gvf_magnitude.data, <np.uint8_t*> gvf_angle.data, width, height,
+                                 <long long*> frames.data, <double*> points.data, points_n, scale, exact, out_ptr)
+
+    return out
+
+
+# Types of scalar fields sampled natively, other types are converted to double
+ctypedef fused field_t:
+    np.uint8_t
+    np.uint16_t
+    np.int32_t
+    np.int64_t
+    np.float32_t
+    np.float64_t
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _sample_sf(np.ndarray[field_t, ndim=2, mode="c"] field not None,
+               np.ndarray[double, ndim=2, mode="c"] points not None,
+               bool interp):
+
+    width, height = field.shape[1], field.shape[0]
+    points_n = points.shape[0]
+
+    cpdef np.ndarray[double, ndim=1, mode="c"] result = np.zeros(points_n, dtype=np.double)
+
+    # Call the C function
+    sample_scalar_field(<field_t*> field.data, width, height, <double*> points.data, points_n, interp, <double*> result.data)
+
+    return result
+
+
+def sample_sf(image, points, interp=True):
+    """
+    Sample scalar field `image` of any numeric type at `points` (x, y) with bilinear interpolation or
+    at the pixel containing the point (interp=False). Points outside the image are sampled as zeros,
+    neighbours outside the image are zeros during interpolation.
+    Returns array of shape (N, 1) and the same type as `image` (like snakes.sample_sf).
+    """
+    image = np.ascontiguousarray(image)
+    if image.dtype == np.bool_:
+        field = image.view(np.uint8)
+    elif image.dtype in (np.uint8, np.uint16, np.int32, np.int64, np.float32, np.float64):
+        field = image
+    else:
+        field = image.astype(np.double)
+
+    points = np.ascontiguousarray(points, dtype=np.double).reshape(-1, 2)
+
+    return _sample_sf(field, points, interp).reshape(-1, 1).astype(image.dtype, copy=False)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def evolve_snake(np.ndarray[double, ndim=2, mode="c"] points not None, gvf,
+                 np.ndarray[double, ndim=2, mode="c"] stretching_potential not None,
+                 br_f0, br_f1, br_offsets, factor, double dt, int iter_n, double motion_threshold,
+                 double b_mult=100.0, trajectory=None, history=None, buffer=None, double gvf_scale=2.0,
+                 stage_times=None):
+    """
+    Evolve snake `points` of shape (N, 2) in place until it converges or `iter_n` iterations are made, the whole
+    iteration loop of Tracker.evolve_snake runs natively without the GIL.
+    `gvf` is the pair of 2x upscaled GVF images: uint8 (magnitude, angle) or decoded float32 (x, y), points are
+    sampled at `gvf_scale` * points (2 / 2^l for the level l of the GVF pyramid).
+    `factor` is the banded Cholesky factor of the snake matrix (see snakes.SnakeSolver), `br_f0` and `br_f1` are
+    branching forces (f_x, f_y) at the endpoints placed at `br_offsets` (or None).
+    Iterations are written to `trajectory` of shape (iter_n + 1, N, 2) and to the ring buffer `history` of shape
+    (K, N, 2), if given. `buffer` is a work array of shape (5, N) (allocated if None).
+    Times of the stages (GVF sampling, constraint forces, linear solve, reparametrization) of every 16-th iteration
+    are added to the first four values of `stage_times` of shape (5,) and the number of timed iterations to the last
+    one, if given.
+    Returns number of iterations made.
+    """
+    point_n = points.shape[0]
+
+    cdef np.ndarray[double, ndim=2, mode="c"] factor_c = np.ascontiguousarray(factor, dtype=np.double)
+
+    if factor_c.shape[1] != point_n or point_n < 2:
+        raise ValueError("factor has to be of shape (bands + 1, N), N > 1")
+
+    # Branching forces and positions of their windows
+    offsets = np.zeros((2, 2)) if br_offsets is None else np.asarray(br_offsets, dtype=np.double).reshape(2, 2)
+
+    arrays = []
+    cdef VectorField br0 = vector_field(br_f0, offsets[0], arrays)
+    cdef VectorField br1 = vector_field(br_f1, offsets[1], arrays)
+
+    # Gradient vector flow
+    cdef GradientField gvf_field = gradient_field(gvf, gvf_scale, arrays)
+
+    # Caller-provided buffers
+    cdef double *trajectory_ptr = NULL
+    cdef double *history_ptr = NULL
+    cdef int history_size = 0
+    if trajectory is not None:
+        trajectory_ptr = array_data(trajectory, (iter_n + 1, point_n, 2), "trajectory")
+    if history is not None and len(history) > 0:
+        history_size = len(history)
+        history_ptr = array_data(history, (history_size, point_n, 2), "history")
+    if buffer is None:
+        buffer = np.empty((5, point_n), dtype=np.double)
+    cdef double *buffer_ptr = array_data(buffer, (5, point_n), "buffer")
+    cdef double *stage_times_ptr = NULL
+    if stage_times is not None:
+        stage_times_ptr = array_data(stage_times, (5,), "stage_times")
+
+    cdef double *points_ptr = <double*> points.data
+    cdef double *stretching_ptr = <double*> stretching_potential.data
+    cdef int width = stretching_potential.shape[1], height = stretching_potential.shape[0]
+    cdef double *factor_ptr = <double*> factor_c.data
+    cdef int bands_n = factor_c.shape[0] - 1
+    cdef int snake_n = point_n
+    cdef int iter_i
+
+    # Call the C function
+    with nogil:
+        iter_i = c_evolve_snake(points_ptr, snake_n, gvf_field, stretching_ptr, width, height, br0, br1,
+                                factor_ptr, bands_n, dt, b_mult, iter_n, motion_threshold,
+                                trajectory_ptr, history_ptr, history_size, buffer_ptr, stage_times_ptr)
+
+    return iter_i
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def evolve_snakes(snakes, gvf, np.ndarray[double, ndim=2, mode="c"] stretching_potential not None,
+                  br_forces, br_offsets, factors, double dt, iter_ns, double motion_threshold,
+                  double b_mult=100.0, trajectories=None, histories=None, double gvf_scale=2.0, stage_times=None):
+    """
+    Evolve snakes of the same frame together, every snake of `snakes` (arrays of shape (N_k, 2) updated in place)
+    is evolved the same as by `evolve_snake` until it converges or `iter_ns[k]` iterations are made. Every iteration
+    samples `gvf` at the points of all active snakes in one call, the whole loop runs natively without the GIL.
+    `br_forces` are pairs of branching forces (br_f0, br_f1) of the snakes placed at `br_offsets` (pairs of offsets
+    or None), `factors` are banded Cholesky factors of the snake matrices (see snakes.SnakeSolver).
+    Iterations of the k-th snake are written to `trajectories[k]` of shape (iter_ns[k] + 1, N_k, 2) and to the ring
+    buffer `histories[k]` of shape (K, N_k, 2), if given. Stages are timed in `stage_times` as by `evolve_snake`.
+    Returns numbers of iterations made by the snakes.
+    """
+    snake_n = len(snakes)
+    if len(br_forces) != snake_n or len(factors) != snake_n or len(iter_ns) != snake_n:
+        raise ValueError("br_forces, factors and iter_ns have to be given for every snake")
+
+    arrays = []
+    cdef GradientField gvf_field = gradient_field(gvf, gvf_scale, arrays)
+
+    cdef vector[BatchSnake] batch
+    batch.resize(snake_n)
+    cdef np.ndarray factor_c
+    cdef int history_size = 0
+    total_n, max_n = 0, 0
+    for k in range(snake_n):
+        point_n = len(snakes[k])
+        factor_c = np.ascontiguousarray(factors[k], dtype=np.double)
+        arrays.append(factor_c)
+        if factor_c.ndim != 2 or factor_c.shape[1] != point_n or point_n < 2:
+            raise ValueError("factors have to be of shape (bands + 1, N_k), N_k > 1")
+
+        # Branching forces and positions of their windows
+        if br_offsets is None or br_offsets[k] is None:
+            offsets = np.zeros((2, 2))
+        else:
+            offsets = np.asarray(br_offsets[k], dtype=np.double).reshape(2, 2)
+
+        batch[k].points = array_data(snakes[k], (point_n, 2), "snake")
+        batch[k].point_n = point_n
+        batch[k].br0 = vector_field(br_forces[k][0], offsets[0], arrays)
+        batch[k].br1 = vector_field(br_forces[k][1], offsets[1], arrays)
+        batch[k].factor = <double*> factor_c.data
+        batch[k].bands_n = factor_c.shape[0] - 1
+        batch[k].iter_n = iter_ns[k]
+
+        # Caller-provided buffers
+        batch[k].trajectory = NULL
+        batch[k].history = NULL
+        if trajectories is not None and trajectories[k] is not None:
+            batch[k].trajectory = array_data(trajectories[k], (iter_ns[k] + 1, point_n, 2), "trajectory")
+        if histories is not None and histories[k] is not None and len(histories[k]) > 0:
+            history_size = len(histories[k])
+            batch[k].history = array_data(histories[k], (history_size, point_n, 2), "history")
+
+        total_n += point_n
+        max_n = max(max_n, point_n)
+
+    for k in range(snake_n):
+        if batch[k].history != NULL and len(histories[k]) != history_size:
+            raise ValueError("histories have to be of the same length")
+
+    cdef np.ndarray[np.int32_t, ndim=1, mode="c"] iterations = np.zeros(snake_n, dtype=np.int32)
+    buffer = np.empty(6 * total_n + max_n, dtype=np.double)
+    cdef double *buffer_ptr = array_data(buffer, (6 * total_n + max_n,), "buffer")
+    cdef double *stage_times_ptr = NULL
+    if stage_times is not None:
+        stage_times_ptr = array_data(stage_times, (5,), "stage_times")
+
+    cdef double *stretching_ptr = <double*> stretching_potential.data
+    cdef int width = stretching_potential.shape[1], height = stretching_potential.shape[0]
+    cdef int batch_n = snake_n
+
+    # Call the C function
+    with nogil:
+        c_evolve_snakes(batch.data(), batch_n, gvf_field, stretching_ptr, width, height, dt, b_mult, motion_threshold,
+                        history_size, buffer_ptr, <int*> iterations.data, stage_times_ptr)
+
+    return iterations
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def reparametrize_contour(np.ndarray[double, ndim=2, mode="c"] points not None, int point_n, out=None, buffer=None):
+    """
+    Linear reparametrization of the contour `points` of shape (N, 2) by `point_n` points uniformly distributed
+    by arc length (segments are found as in scipy.interpolate.interp1d).
+    The result is written to `out` of shape (point_n, 2), which must not overlap `points`, and `buffer` of N values
+    keeps the arc length (both are allocated if None).
+    Returns the new contour and its step.
+    """
+    contour_n = points.shape[0]
+
+    if contour_n < 2 or point_n < 1:
+        raise ValueError("contour has to have at least 2 points")
+
+    if out is None:
+        out = np.empty((point_n, 2), dtype=np.double)
+    if buffer is None:
+        buffer = np.empty(contour_n, dtype=np.double)
+    cdef double *out_ptr = array_data(out, (point_n, 2), "out")
+    cdef double *buffer_ptr = array_data(buffer, (contour_n,), "buffer")
+    cdef double *points_ptr = <double*> points.data
+    cdef int points_n = contour_n
+    cdef double step
+
+    # Call the C function
+    with nogil:
+        step = c_reparametrize_contour(points_ptr, points_n, buffer_ptr, out_ptr, point_n)
+
+    return out, step
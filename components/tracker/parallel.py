@@ -10,25 +10,382 @@
 #
 
 import os
+import csv
 import sys
+import json
+import shutil
 sys.path.append("../common")
 
 import traceback
 import numpy as np
 import multiprocessing as mp
+from Queue import Empty
 
 from modules.track import Tracker, TrackerParams
+from modules.batch import BatchTracker
+from modules.snakes import gen_gauss_kernel
+from modules.utils import gen_frame_potentials
 from modules.parametrize import uniform_contour_reparametrization as reparametrize
+from modules.timing import StageProfile
+from timeit import default_timer
 from ticker import Ticker
-from zip import zip_csv
-from utils import unpack_values, pack_shared_memory, to_image_sequence
+from zip import zip_csv, pack_contours, unpack_contours, NpzWriter
+from utils import unpack_values, pack_shared_memory, to_image_sequence, to_shared_memory, append_manifest, \
+    read_manifest
 
 
 Global_Parameters = None
 Global_Sequence = None
 Global_Lock = None
 
-Output_Folder = ""
+# Stages of the jobs tracked by the process since the last result was returned
+Global_Profile = StageProfile()
+
+
+def initial_snake(initial_polyline):
+    """
+    Reparametrize initial polyline of a filament to the snake with the discretization step of the tracker.
+    The final state of a previous run (dictionary, see `FilamentState.final_state`) is returned as it is.
+    """
+    if isinstance(initial_polyline, dict):
+        return initial_polyline
+    new_x, new_y, new_step = reparametrize(initial_polyline[:, 0], initial_polyline[:, 1],
+                                           Global_Parameters.delta, 'linear')
+    return np.dstack([new_x, new_y])[0]
+
+
+def filament_cost(initial_polyline, delta):
+    """
+    Estimate the tracking cost of a filament: every iteration of the evolution is linear in the number of snake
+    points (length of the polyline over the discretization step), the polyline points are reparametrized once
+    """
+    if isinstance(initial_polyline, dict):
+        initial_polyline = initial_polyline["contour"]
+    length = np.sum(np.linalg.norm(np.diff(initial_polyline, axis=0), axis=1))
+    return length / delta + len(initial_polyline)
+
+
+def start_frame(initial_polyline):
+    """
+    First frame tracked for a filament: 0 or the frame after the final state of a previous run
+    """
+    if isinstance(initial_polyline, dict):
+        return int(initial_polyline["frame"]) + 1
+    return 0
+
+
+def job_cost(job, delta):
+    """
+    Estimate the tracking cost of a job: a filament (name, polyline) or a batch of filaments
+    """
+    if isinstance(job, list):
+        return sum(filament_cost(initial_polyline, delta) for _, initial_polyline in job)
+    return filament_cost(job[1], delta)
+
+
+def longest_first(jobs, delta):
+    """
+    Enumerate `jobs` in the order of decreasing estimated cost (indices of the jobs are kept)
+    """
+    costs = [job_cost(job, delta) for job in jobs]
+    order = sorted(xrange(len(jobs)), key=lambda i: -costs[i])
+    return [(i, jobs[i]) for i in order], [costs[i] for i in order]
+
+
+def balance_groups(groups, proc_num, delta):
+    """
+    Split `groups` into `proc_num` subsets of similar estimated cost: the most expensive group is given
+    to the least loaded subset first
+    """
+    subsets = [[] for _ in xrange(proc_num)]
+    loads = np.zeros(proc_num)
+    for (_, group), cost in zip(*longest_first(groups, delta)):
+        k = np.argmin(loads)
+        subsets[k].append(group)
+        loads[k] += cost
+    return subsets
+
+
+class Progress(object):
+    """
+    Report the share of finished jobs, weighted by their estimated costs
+    """
+
+    def __init__(self, costs):
+        self.total_cost = max(sum(costs), 1.0e-12)
+        self.total_n = len(costs)
+        self.done_cost = 0.0
+        self.done_n = 0
+        self.ticker = Ticker()
+        self.ticker.tick(" Tracking {0} jobs.".format(self.total_n))
+
+    def update(self, cost):
+        self.done_cost += cost
+        self.done_n += 1
+        self.ticker.tock("  Progress: {0}/{1} jobs, {2:.1f}% of estimated work.".format(
+            self.done_n, self.total_n, 100.0 * self.done_cost / self.total_cost))
+
+
+def compact_result(result):
+    """
+    Convert tracking result of a filament to the arrays that are sent to the result writer
+    """
+    contours, sizes = pack_contours(result["snake_contours"])
+    compact = {'contours': contours, 'sizes': sizes}
+    # Last iterations of the evolution
+    if result["snake_history"] is not None:
+        compact['history'] = np.asarray(result["snake_history"])
+    # Branching potentials around the endpoints
+    if result["branching_potential"] is not None:
+        compact['potentials'] = np.asarray(result["branching_potential"])
+        compact['offsets'] = np.asarray(result["branching_offsets"])
+    # Iterations of the evolution on every frame (iterations saved by the warm start and made on the coarse levels)
+    compact['iterations'] = np.asarray(result["snake_iterations"], dtype=np.int32)
+    if result["iterations_saved"] is not None:
+        compact['iterations_saved'] = np.asarray(result["iterations_saved"], dtype=np.int32)
+    if np.any(result["coarse_iterations"]):
+        compact['coarse_iterations'] = np.asarray(result["coarse_iterations"], dtype=np.int32)
+    # Trajectories of the endpoints and the final state, tracking can be continued from it on appended frames
+    compact['first_frame'] = np.asarray(result["first_frame"], dtype=np.int64)
+    compact['ends'] = np.asarray(result["ends_trajectories"])
+    final_state = result["final_state"]
+    if final_state is not None:
+        compact['last_frame'] = np.asarray(final_state["frame"], dtype=np.int64)
+        compact['last_contour'] = np.asarray(final_state["contour"])
+        compact['last_ends'] = np.asarray(final_state["ends"])
+        compact['ends_initialized'] = np.asarray(final_state["initialized"])
+    return compact
+
+
+def final_states(results):
+    """
+    Final states of filaments (see `FilamentState.final_state`) from compact results: name -> state
+    (filaments without the final state are skipped)
+    """
+    states = dict()
+    for filename, compact in results.items():
+        if 'last_frame' in compact:
+            states[filename] = {
+                "frame": int(compact['last_frame']),
+                "contour": compact['last_contour'],
+                "ends": compact['last_ends'],
+                "initialized": compact['ends_initialized']
+            }
+    return states
+
+
+class ResultWriter(object):
+    """
+    Writer of tracking results, it runs in the main process only (workers return compact results to it).
+    Format 'store' appends all filaments to the single archive tracks.npz (arrays '<filament>/contours',
+    '<filament>/sizes' and optionally '<filament>/history', '<filament>/potentials', '<filament>/offsets'),
+    format 'zip' writes <filament>.zip of per-frame CSVs and separate history/potentials files.
+    With `checkpoint` every result is flushed to disk as soon as it is written and recorded in the run manifest,
+    the store is then assembled from the saved results when tracking is finished.
+    Iterations of the evolution are summed up per frame and reported to iterations.csv, together with the
+    profile of the tracking stages (summed up over all processes) they are also reported to profile.json.
+    Manifest records keep iterations of the filaments and the profile of the run, so that the reports of a resumed
+    run cover the filaments tracked before it was interrupted.
+    """
+
+    # Columns of iterations.csv (snakes that stopped by the motion threshold before the maximum iterations converge)
+    iteration_columns = ['frame', 'filaments', 'iterations', 'iterations_saved', 'coarse_iterations', 'converged']
+
+    state_fields = ['first_frame', 'ends', 'last_frame', 'last_contour', 'last_ends', 'ends_initialized',
+                    'iterations', 'iterations_saved', 'coarse_iterations']
+    fields = ['contours', 'sizes', 'history', 'potentials', 'offsets'] + state_fields
+
+    def __init__(self, output_folder, store_format='zip', checkpoint=False, max_iter_n=None):
+        self.output_folder = output_folder
+        self.checkpoint = checkpoint
+        self.checkpoint_folder = os.path.join(output_folder, 'checkpoint')
+        self.is_store = store_format == 'store'
+        self.store = None
+        if self.is_store and not checkpoint:
+            self.store = NpzWriter(os.path.join(output_folder, 'tracks.npz'))
+        if self.is_store and checkpoint and not os.path.isdir(self.checkpoint_folder):
+            os.makedirs(self.checkpoint_folder)
+        # Frame -> [number of filaments, iterations, iterations saved by the warm start, coarse iterations,
+        # converged snakes]
+        self.frame_iterations = dict()
+        self.compared = False
+        self.max_iter_n = max_iter_n
+        # Time and calls of the tracking stages of all processes
+        self.profile = StageProfile()
+        self.start_time = default_timer()
+        # Profile and wall time of the previous runs of the run folder (see `read_previous_runs`)
+        # and the part of the profile of this run that is already recorded in the manifest
+        self.previous_profile = StageProfile()
+        self.previous_time = 0.0
+        self.recorded_profile = StageProfile()
+        self.recorded_time = 0.0
+        if checkpoint:
+            self.read_previous_runs()
+
+    def write(self, filename, compact):
+        self.count_iterations(compact)
+        try:
+            if self.store is not None:
+                for field in self.fields:
+                    if field in compact:
+                        self.store.write('{0}/{1}'.format(filename, field), compact[field])
+            elif self.is_store:
+                self.write_checkpoint(filename, compact)
+            else:
+                self.write_zip(filename, compact)
+            if self.checkpoint:
+                append_manifest(self.output_folder, self.manifest_record(filename, compact))
+        except Exception as e:
+            print e
+            traceback.print_exc()
+            print "  Cannot save: " + filename
+
+    def write_checkpoint(self, filename, compact):
+        # Save to a temporary file first, a result that is recorded in the manifest is always complete
+        path = os.path.join(self.checkpoint_folder, '{0}.npz'.format(filename))
+        with open(path + '.tmp', 'wb') as fout:
+            np.savez(fout, **compact)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.rename(path + '.tmp', path)
+
+    def write_zip(self, filename, compact):
+        # Save ZIP
+        zip_csv(os.path.join(self.output_folder, '{0}.zip'.format(filename)),
+                unpack_contours(compact['contours'], compact['sizes']))
+        # Save last iterations of the evolution
+        if 'history' in compact:
+            np.save(os.path.join(self.output_folder, '{0}_history.npy'.format(filename)), compact['history'])
+        # Save branching potentials around the endpoints
+        if 'potentials' in compact:
+            np.savez(os.path.join(self.output_folder, '{0}_potentials.npz'.format(filename)),
+                     potentials=compact['potentials'], offsets=compact['offsets'])
+        # Save trajectories of the endpoints and the final state
+        state = dict((field, compact[field]) for field in self.state_fields if field in compact)
+        np.savez(os.path.join(self.output_folder, '{0}_state.npz'.format(filename)), **state)
+
+    def manifest_record(self, filename, compact):
+        """
+        Record of the saved filament for the run manifest: its iterations and the profile of the run
+        since the previous record (all records of a run add up to its profile)
+        """
+        recorded = self.recorded_profile.stages
+        stages = dict((stage, [seconds - recorded.get(stage, [0.0, 0])[0], calls - recorded.get(stage, [0.0, 0])[1]])
+                      for stage, (seconds, calls) in self.profile.stages.items())
+        self.recorded_profile.merge(stages)
+        elapsed = default_timer() - self.start_time
+        record = {'filament': filename, 'first_frame': int(compact.get('first_frame', 0)),
+                  'stages': stages, 'wall_time': elapsed - self.recorded_time}
+        self.recorded_time = elapsed
+        for field in ['iterations', 'iterations_saved', 'coarse_iterations']:
+            if field in compact:
+                record[field] = np.asarray(compact[field]).tolist()
+        return record
+
+    def read_previous_runs(self):
+        """
+        Count iterations and add up the profiles of the filaments recorded in the run manifest by previous runs
+        """
+        for record in read_manifest(self.output_folder):
+            if 'filament' in record:
+                self.count_iterations(record)
+                self.previous_profile.merge(record.get('stages', dict()))
+                self.previous_time += record.get('wall_time', 0.0)
+
+    def count_iterations(self, compact):
+        first_frame = int(compact.get('first_frame', 0))
+        iterations = compact.get('iterations', [])
+        self.compared |= 'iterations_saved' in compact
+        saved = compact.get('iterations_saved', np.zeros(len(iterations), dtype=np.int32))
+        coarse = compact.get('coarse_iterations', np.zeros(len(iterations), dtype=np.int32))
+        for frame_i, (iteration_n, saved_n, coarse_n) in enumerate(zip(iterations, saved, coarse)):
+            counts = self.frame_iterations.setdefault(first_frame + frame_i, [0, 0, 0, 0, 0])
+            counts[0] += 1
+            counts[1] += int(iteration_n)
+            counts[2] += int(saved_n)
+            counts[3] += int(coarse_n)
+            counts[4] += int(self.max_iter_n is None or iteration_n + coarse_n < self.max_iter_n)
+
+    def report_iterations(self):
+        """
+        Save numbers of iterations per frame to iterations.csv and print their totals
+        """
+        if len(self.frame_iterations) == 0:
+            return
+        rows = [[frame_i] + self.frame_iterations[frame_i] for frame_i in sorted(self.frame_iterations)]
+        with open(os.path.join(self.output_folder, 'iterations.csv'), 'w') as fout:
+            writer = csv.writer(fout)
+            writer.writerow(self.iteration_columns)
+            writer.writerows(rows)
+        total = np.sum([row[2:] for row in rows], axis=0)
+        print " Iterations: {0} in total, {1:.1f} per frame.".format(total[0], float(total[0]) / len(rows))
+        if self.compared:
+            print " Iterations saved by the warm start: {0} in total, {1:.1f} per frame.".format(
+                total[1], float(total[1]) / len(rows))
+        if total[2] > 0:
+            print " Iterations on the coarse levels: {0} in total, {1:.1f} per frame.".format(
+                total[2], float(total[2]) / len(rows))
+
+    def report_profile(self):
+        """
+        Save time and calls of the tracking stages and iterations per frame to profile.json and print the stages.
+        Stages of the evolution iterations (gvf_sampling, constraint_forces, linear_solve, reparametrization)
+        are parts of the stage 'evolution', in the native evolution they are estimated from sampled iterations.
+        """
+        profile = StageProfile()
+        profile.merge(self.previous_profile.stages)
+        profile.merge(self.profile.stages)
+        stages = profile.stages
+        report = {
+            'wall_time': self.previous_time + default_timer() - self.start_time,
+            'stages': dict((stage, {'seconds': seconds, 'calls': calls}) for stage, (seconds, calls) in stages.items()),
+            'frames': [dict(zip(self.iteration_columns, [frame_i] + self.frame_iterations[frame_i]))
+                       for frame_i in sorted(self.frame_iterations)]
+        }
+        with open(os.path.join(self.output_folder, 'profile.json'), 'w') as fout:
+            json.dump(report, fout, indent=2, sort_keys=True)
+        print " Stages (time summed up over all processes, wall time {0:.2f} s):".format(report['wall_time'])
+        for stage in sorted(stages, key=lambda name: -stages[name][0]):
+            print "  {0}: {1:.3f} s, {2} calls".format(stage, stages[stage][0], stages[stage][1])
+
+    def write_all(self, results, stages=None):
+        """
+        Write a list of (filename, compact result) pairs, `stages` of the processes that tracked them
+        are added to the profile first. Returns names of the filaments
+        """
+        if stages is not None:
+            self.profile.merge(stages)
+        for filename, compact in results:
+            self.write(filename, compact)
+        return [filename for filename, _ in results]
+
+    def close(self):
+        """
+        Finish the store, checkpointed results (of this and of previous runs) are moved into it
+        """
+        self.report_iterations()
+        self.report_profile()
+        if self.store is not None:
+            self.store.close()
+        elif self.is_store and self.checkpoint:
+            checkpoints = sorted(fn for fn in os.listdir(self.checkpoint_folder) if fn.endswith('.npz'))
+            store_path = os.path.join(self.output_folder, 'tracks.npz')
+            store = NpzWriter(store_path + '.tmp')
+            filenames = [os.path.splitext(checkpoint)[0] for checkpoint in checkpoints]
+            # Keep filaments of the store assembled by a previous run (unless they are tracked again)
+            if os.path.exists(store_path):
+                with np.load(store_path) as previous:
+                    for key in previous.files:
+                        if key.rpartition('/')[0] not in filenames:
+                            store.write(key, previous[key])
+            for filename, checkpoint in zip(filenames, checkpoints):
+                with np.load(os.path.join(self.checkpoint_folder, checkpoint)) as compact:
+                    for field in self.fields:
+                        if field in compact.files:
+                            store.write('{0}/{1}'.format(filename, field), compact[field])
+            store.close()
+            os.rename(store_path + '.tmp', store_path)
+            shutil.rmtree(self.checkpoint_folder)
 
 
 def track_individual(input):
@@ -37,7 +394,6 @@ def track_individual(input):
     global Global_Sequence
     global Global_Parameters
     global Global_Lock
-    global Output_Folder
 
     # Initialize ticker
     ticker = Ticker(Global_Lock)
@@ -49,16 +405,13 @@ def track_individual(input):
     ticker.tick(" Started tracking {0}.".format(filename))
 
     # Reparametrize contour
-    new_x, new_y, new_step = reparametrize(initial_polyline[:, 0], initial_polyline[:, 1],
-                                           Global_Parameters.delta, 'linear')
+    initial_points = initial_snake(initial_polyline)
+    tracking_result = []
 
-    initial_points = np.dstack([new_x, new_y])[0]
-    tracking_result = None
+    # Create tracker
+    tracker = Tracker(Global_Sequence, Global_Parameters)
 
     try:
-        # Create tracker
-        tracker = Tracker(Global_Sequence, Global_Parameters)
-
         # Initialize log
         log = ""
         result = tracker.track(initial_points, log)
@@ -66,41 +419,273 @@ def track_individual(input):
         ticker.tock("  Finished: " + filename)
 
         if result is not None:
-            if Global_Lock is not None:
-                Global_Lock.acquire()
-            try:
-                zip_path = os.path.join(Output_Folder, '{0}.zip'.format(filename))
-                # Save ZIP
-                zip_csv(zip_path, result["snake_trajectory"][:, -1])
-            except:
-                pass
-            if Global_Lock is not None:
-                Global_Lock.release()
+            tracking_result.append((filename, compact_result(result)))
     except Exception as e:
         print e
         traceback.print_exc()
         ticker.tock("  Failed: " + filename)
 
+    # Collect the profile of the tracking stages
+    Global_Profile.merge(tracker.profile.pop())
+
     return tracking_result
 
 
+def track_batch(input):
+
+    # Initialize global variables
+    global Global_Sequence
+    global Global_Parameters
+    global Global_Lock
+
+    # Initialize ticker
+    ticker = Ticker(Global_Lock)
+
+    # Unpack data
+    index, data = input
+    filenames = [filename for filename, _ in data]
+
+    ticker.tick(" Started tracking batch {0}: {1}.".format(index, ", ".join(filenames)))
+
+    # Reparametrize contours
+    initial_points = [initial_snake(initial_polyline) for _, initial_polyline in data]
+    tracking_result = []
+
+    # Create tracker
+    tracker = BatchTracker(Global_Sequence, Global_Parameters)
+
+    try:
+        # Initialize log
+        log = ""
+        results = tracker.track_batch(initial_points, log)
+
+        ticker.tock("  Finished batch {0}:".format(index))
+
+        for filename, result in zip(filenames, results):
+            if result is not None:
+                tracking_result.append((filename, compact_result(result)))
+            else:
+                print "  Failed: {0} (endpoints are lost)".format(filename)
+    except Exception as e:
+        print e
+        traceback.print_exc()
+        ticker.tock("  Failed batch {0}:".format(index))
+
+    # Collect the profile of the tracking stages
+    Global_Profile.merge(tracker.profile.pop())
+
+    return tracking_result
+
+
+def track_indexed(input):
+    """
+    Track the job `item` with `track_job` and return its index along with the result (for unordered dispatch)
+    and the profile of the tracking stages
+    """
+    track_job, item = input
+    result = track_job(item)
+    return item[0], result, Global_Profile.pop()
+
+
+class FrameWorker(object):
+    """
+    Filaments tracked by one process of the frame-major scheduler. Tracking states are kept between frames,
+    `step` advances all filaments of the worker by one frame.
+    """
+
+    def __init__(self, groups):
+        self.tracker = BatchTracker(Global_Sequence, Global_Parameters)
+        # Groups of filaments evolved together (a group of one filament is tracked individually)
+        self.groups = []
+        for group in groups:
+            filenames = [filename for filename, _ in group]
+            states = [self.tracker.start(initial_snake(initial_polyline)) for _, initial_polyline in group]
+            self.groups.append((filenames, states))
+
+    def step(self, image_i):
+        """
+        Track all filaments of the worker on frame `image_i`, a group that fails is not tracked further
+        """
+        # Advect initial snakes of all filaments of the worker with optical flow at once
+        # (filaments continued from a previous run start later)
+        started = [[state for state in states if state.first_frame <= image_i] if states is not None else []
+                   for _, states in self.groups]
+        try:
+            self.tracker.warm_start([state for group in started for state in group], image_i)
+        except Exception as e:
+            print e
+            traceback.print_exc()
+            print "  Warm start failed on frame {0}".format(image_i)
+
+        for k, (filenames, states) in enumerate(self.groups):
+            if states is None or len(started[k]) == 0:
+                continue
+            try:
+                if len(started[k]) == 1:
+                    self.tracker.track_frame(started[k][0], image_i, warm_start=False, track_ends=False)
+                else:
+                    self.tracker.track_frame_batch(started[k], image_i, warm_start=False, track_ends=False)
+            except Exception as e:
+                self.fail(k, image_i, e)
+
+        # Track endpoints of all filaments of the worker to the next frame at once,
+        # if it fails, groups are tracked one by one
+        tracked = [k for k, (_, states) in enumerate(self.groups) if states is not None and len(started[k]) > 0]
+        try:
+            lost = self.tracker.track_next_endpoints([state for k in tracked for state in started[k]], image_i)
+        except Exception:
+            lost = []
+            for k in tracked:
+                try:
+                    lost.extend(self.tracker.track_next_endpoints(started[k], image_i))
+                except Exception as e:
+                    self.fail(k, image_i, e)
+        for k in tracked:
+            if self.groups[k][1] is not None and any(state in lost for state in started[k]):
+                self.lose(k, lost, image_i)
+
+    def fail(self, k, image_i, e):
+        """
+        Report failure of the group `k` on frame `image_i`, the group is not tracked further
+        """
+        filenames = self.groups[k][0]
+        print e
+        traceback.print_exc()
+        print "  Failed: {0} on frame {1}".format(", ".join(filenames), image_i)
+        self.groups[k] = (filenames, None)
+
+    def lose(self, k, lost, image_i):
+        """
+        Report filaments of the group `k` whose endpoints are `lost` on frame `image_i`,
+        they are not tracked further (the other filaments of the group continue)
+        """
+        filenames, states = self.groups[k]
+        keep = [state not in lost for state in states]
+        print "  Failed: {0} on frame {1} (endpoints are lost)".format(
+            ", ".join(filename for filename, is_kept in zip(filenames, keep) if not is_kept), image_i)
+        self.groups[k] = ([filename for filename, is_kept in zip(filenames, keep) if is_kept],
+                          [state for state, is_kept in zip(states, keep) if is_kept])
+
+    def finish(self):
+        """
+        Compact results of all tracked filaments: list of (filename, compact result)
+        """
+        results = []
+        for filenames, states in self.groups:
+            if states is not None:
+                for filename, state in zip(filenames, states):
+                    results.append((filename, compact_result(state.result())))
+        return results
+
+
+def frame_worker(worker_i, groups, commands, reports, arguments):
+    """
+    Process of the frame-major scheduler: tracks `groups` of filaments frame by frame, indices of frames come
+    from `commands` (None finishes tracking) and every processed frame is reported to `reports`,
+    results and the profile of the tracking stages are sent with the last report
+    """
+    init_process(*arguments)
+
+    worker = FrameWorker(groups)
+    for image_i in iter(commands.get, None):
+        worker.step(image_i)
+        reports.put((worker_i, image_i))
+
+    reports.put((worker_i, (worker.finish(), worker.tracker.profile.pop())))
+
+
+def wait_workers(reports, workers):
+    """
+    Wait for a report from every process of `workers` (barrier between frames), returns the reported values
+    """
+    values = [None] * len(workers)
+    pending = set(xrange(len(workers)))
+    while len(pending) > 0:
+        try:
+            worker_i, value = reports.get(timeout=1.0)
+            values[worker_i] = value
+            pending.discard(worker_i)
+        except Empty:
+            if not all(workers[i].is_alive() for i in pending):
+                raise RuntimeError("Tracking process terminated unexpectedly")
+    return values
+
+
+def track_frame_major(groups, first_frame, frame_n, proc_num, arguments, writer):
+    """
+    Frame-major scheduler: disjoint subsets of filament `groups` are tracked by `proc_num` processes on the same
+    frame, the processes wait for each other before the next frame, so they read the same frame data at once.
+    Results are written by `writer` in the main process when the last frame is tracked (a checkpoint of
+    an interrupted run has no filaments).
+    """
+    ticker = Ticker()
+
+    proc_num = max(1, min(proc_num, len(groups)))
+    commands = [mp.Queue() for _ in xrange(proc_num)]
+    reports = mp.Queue()
+    subsets = balance_groups(groups, proc_num, arguments[0].delta)
+    workers = [mp.Process(target=frame_worker, args=(i, subsets[i], commands[i], reports, arguments))
+               for i in xrange(proc_num)]
+    for worker in workers:
+        worker.start()
+
+    try:
+        for image_i in xrange(first_frame, frame_n):
+            ticker.tick(" Started frame {0}.".format(image_i))
+            for command in commands:
+                command.put(image_i)
+            wait_workers(reports, workers)
+            ticker.tock("  Finished frame {0}:".format(image_i))
+
+        # Collect and save results
+        for command in commands:
+            command.put(None)
+        names = []
+        for results, stages in wait_workers(reports, workers):
+            names.extend(writer.write_all(results, stages))
+    finally:
+        for worker in workers:
+            worker.join(1.0)
+            if worker.is_alive():
+                worker.terminate()
+
+    return names
+
+
 def init_process(*args):
 
     global Global_Sequence
     global Global_Parameters
     global Global_Lock
-    global Output_Folder
 
     # Initialize globals
     Global_Parameters = args[0]
-    Output_Folder = args[1]
-    Global_Lock = args[2]
+    Global_Lock = args[1]
 
-    unpacked_values = unpack_values(args[3:])
+    unpacked_values = unpack_values(args[2:])
     Global_Sequence = to_image_sequence(unpacked_values)
 
 
-def track_all(initial_positions, image_sequence, tracker_config, output_folder):
+def precompute_potentials(sequence, params, frames):
+    """
+    Generate branching potentials of all branching points on `frames` once for all filaments.
+    Returns layers of the image sequence that are read by Tracker.frame_potential.
+    """
+    if len(frames) == 0:
+        return {}
+    kernel = gen_gauss_kernel(params.kernel_sigma, params.kernel_size)
+    potentials, forces_x, forces_y, masks = gen_frame_potentials(sequence.branching_coords, frames,
+                                                                 sequence.enhanced.shape[1:], kernel)
+    return {
+        'branching_frames': ('i', np.asarray(frames, dtype=np.int64)),
+        'branching_potential': ('i', potentials),
+        'branching_force_x': ('i', forces_x),
+        'branching_force_y': ('i', forces_y),
+        'branching_mask': ('i', masks)
+    }
+
+
+def track_all(initial_positions, image_sequence, tracker_config, output_folder, checkpoint=False):
 
     # Retrieve tracker parameters
     params = TrackerParams()
@@ -112,22 +697,81 @@ def track_all(initial_positions, image_sequence, tracker_config, output_folder):
     params.kernel_sigma = tracker_config.get("Evolution", "Kernel_Sigma_f", 2.5)
     params.delta = tracker_config.get("Evolution", "Discretization_Step_f", 1.0)
     params.min_shift = tracker_config.get("Evolution", "Minimum_Shift_f", 1.0e-7)
+    params.trajectory_mode = tracker_config.get("Output", "Trajectory", "compact")
+    params.history_size = tracker_config.get("Output", "History_Size_i", 0)
+    params.store_potentials = tracker_config.get("Output", "Branching_Potentials_b", False)
+    params.potential_window = tracker_config.get("Output", "Potential_Window_i", 15)
+    params.warm_start = tracker_config.get("Evolution", "Warm_Start", "previous").strip().lower()
+    params.flow_max_shift = tracker_config.get("Evolution", "Flow_Max_Shift_f", 10.0)
+    params.compare_warm_start = tracker_config.get("Evolution", "Compare_Warm_Start_b", False)
+    params.resolution_levels = tracker_config.get("Evolution", "Resolution_Levels_i", 1)
+    params.coarse_iter_n = tracker_config.get("Evolution", "Coarse_Iterations_i", 200)
+    params.coarse_min_shift = tracker_config.get("Evolution", "Coarse_Minimum_Shift_f", 1.0e-3)
+    params.branch_cost = tracker_config.get("Evolution", "Branch_Cost_f", 0.0)
+
+    # Results are written by the main process only: to a single store or to per-filament ZIPs,
+    # with `checkpoint` every filament is saved as soon as it is tracked
+    writer = ResultWriter(output_folder, tracker_config.get("Output", "Format", "zip").strip().lower(), checkpoint,
+                          params.max_iter_n)
+    results = []
 
     # Create lock
     manager = mp.Manager()
     locker = manager.Lock()
 
-    if not tracker_config["Parallel Computing"]["Enabled_b"]:
-        global Global_Sequence, Global_Parameters, Global_Lock, Output_Folder
+    # Number of filaments evolved together by one process
+    batch_size = tracker_config.get("Parallel Computing", "Batch_Size_i", 1)
+
+    # Scheduler: 'filament' tracks every job through all frames, 'frame' advances all filaments frame by frame
+    frame_major = tracker_config.get("Parallel Computing", "Scheduler", "filament").strip().lower() == 'frame'
+    if batch_size > 1:
+        filaments = initial_positions.items()
+        jobs = [filaments[i:i + batch_size] for i in xrange(0, len(filaments), batch_size)]
+        track_job = track_batch
+        groups = jobs
+    else:
+        jobs = initial_positions.items()
+        track_job = track_individual
+        groups = [[job] for job in jobs]
+
+    # Image sequence in the main process
+    is_parallel = tracker_config["Parallel Computing"]["Enabled_b"]
+    if is_parallel:
+        sequence = to_image_sequence(unpack_values(pack_shared_memory(image_sequence)))
+    else:
+        sequence = to_image_sequence(image_sequence)
+    frame_n = sequence.enhanced.shape[0]
+
+    # Endpoints of every filament are initialized on its first frame, only there the potential
+    # of all branching points is needed (filaments continued from a previous run have initialized endpoints)
+    first_frames = [start_frame(initial_polyline) for initial_polyline in initial_positions.values()]
+    first_frame = min(first_frames) if len(first_frames) > 0 else frame_n
+    start_frames = sorted(set(start_frame(initial_polyline) for initial_polyline in initial_positions.values()
+                              if not isinstance(initial_polyline, dict) or
+                              not all(initial_polyline["initialized"])))
+    start_frames = [frame_i for frame_i in start_frames if frame_i < frame_n]
+
+    if not is_parallel:
+        global Global_Sequence, Global_Parameters, Global_Lock
+        # Precompute branching potentials
+        with writer.profile.measure('potentials'):
+            potentials = precompute_potentials(sequence, params, start_frames)
         # Initialize global variables
         Global_Parameters = params
         Global_Lock = None
-        Global_Sequence = to_image_sequence(image_sequence)
-        Output_Folder = output_folder
-
-        results = []
-        for item in enumerate(initial_positions.items()):
-            results.append(track_individual(item))
+        Global_Sequence = to_image_sequence(dict(image_sequence, **potentials))
+
+        if frame_major:
+            worker = FrameWorker(groups)
+            for image_i in xrange(first_frame, frame_n):
+                worker.step(image_i)
+            results.extend(writer.write_all(worker.finish(), worker.tracker.profile.pop()))
+        else:
+            items, costs = longest_first(jobs, params.delta)
+            progress = Progress(costs)
+            for item, cost in zip(items, costs):
+                results.extend(writer.write_all(track_job(item), Global_Profile.pop()))
+                progress.update(cost)
     else:
         # Get number of processors
         try:
@@ -135,13 +779,34 @@ def track_all(initial_positions, image_sequence, tracker_config, output_folder):
         except:
             proc_num = mp.cpu_count()
 
+        # Precompute branching potentials and share them between processes
+        with writer.profile.measure('potentials'):
+            potentials = to_shared_memory(precompute_potentials(sequence, params, start_frames))
+
         # Initialize arguments list
-        arguments = [params, output_folder, locker]
+        arguments = [params, locker]
         arguments.extend(pack_shared_memory(image_sequence))
+        arguments.extend(pack_shared_memory(potentials))
+
+        if frame_major:
+            results = track_frame_major(groups, first_frame, frame_n, proc_num, arguments, writer)
+            writer.close()
+            return results
+
+        # Dispatch the most expensive jobs first one by one, so that long filaments do not end up last
+        # in a chunk while the other processes are idle
+        items, costs = longest_first(jobs, params.delta)
+        progress = Progress(costs)
 
-        # Create pool and start jobs
+        # Create pool and start jobs, results are written as soon as they arrive
         pool = mp.Pool(proc_num, initializer=init_process, initargs=tuple(arguments))
-        results = pool.map(track_individual, enumerate(initial_positions.items()))
+        job_costs = dict((index, cost) for (index, _), cost in zip(items, costs))
+        for index, result, stages in pool.imap_unordered(track_indexed, [(track_job, item) for item in items],
+                                                         chunksize=1):
+            results.extend(writer.write_all(result, stages))
+            progress.update(job_costs[index])
         pool.close()
+        pool.join()
 
+    writer.close()
     return results
\ No newline at end of file
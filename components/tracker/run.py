@@ -30,35 +30,68 @@ from coder import ParallelMap, ParallelApply
 from datetime import datetime
 
 
-from image import ImageSequence, transform_binary, transform_distance
-from parallel import track_all
+from image import ImageSequence, transform_binary, transform_distance, decode_gvf, gvf_pyramid
+from parallel import track_all, final_states
 from skimage.exposure import rescale_intensity
-from utils import to_shared_memory
+from utils import to_shared_memory, save_cache, load_cache, cached_layer, append_manifest, completed_filaments
 
 
-def upload_sequence(path, processors_num=None, use_shared_memory=False):
-
+def upload_sequence(path, processors_num=None, use_shared_memory=False, decode_gvf_field=False, use_cache=False,
+                    gvf_levels=1, branch_distance=True):
+    """
+    Load and transform the preprocessed image sequence from `path`. Only the layers read by the tracker
+    are loaded: the distance map of branching points (branching.tif) only if `branch_distance` is True.
+    """
     filenames = [
         'enhanced.tif',
         'skeletons.tif',
         'binaries.tif',
-        'branching.tif', # check if we really need this one
+        'branching.tif',
         'gvf_magnitude.tif',
         'gvf_angle.tif',
         'branching_coords.zip'
     ]
+    if not branch_distance:
+        filenames.remove('branching.tif')
 
     ticker = Ticker()
 
+    # Transformed images are cached as memory-mapped .npy files (separately for encoded and decoded GVF
+    # and for every number of levels of the GVF pyramid, the cache is rebuilt if the loaded layers change)
+    cache_folder = os.path.join(path, 'tracker_cache', 'decoded' if decode_gvf_field else 'encoded')
+    if gvf_levels > 1:
+        cache_folder += '_levels_{0}'.format(gvf_levels)
+    sources = [os.path.join(path, filename) for filename in filenames]
+
+    if use_cache:
+        ticker.tick("\nMapping cached image sequence...")
+        image_sequence = load_cache(cache_folder, sources)
+        ticker.tock(" Finished." if image_sequence is not None else " Cache is missing or outdated.")
+        if image_sequence is not None:
+            return to_shared_memory(image_sequence) if use_shared_memory else image_sequence
+
     ticker.tick("\nLoading image sequence...")
     image_sequence = ImageSequence.load(path, filenames)
     ticker.tock(" Finished.")
 
-    return transform_images(image_sequence, processors_num, use_shared_memory)
+    if use_cache:
+        image_sequence = transform_images(image_sequence, processors_num, False, decode_gvf_field, gvf_levels, path)
+        ticker.tick("\nCaching image sequence...")
+        save_cache(cache_folder, image_sequence, sources)
+        image_sequence = load_cache(cache_folder, sources)
+        ticker.tock(" Finished.")
+        return to_shared_memory(image_sequence) if use_shared_memory else image_sequence
 
+    return transform_images(image_sequence, processors_num, use_shared_memory, decode_gvf_field, gvf_levels, path)
 
-def transform_images(image_sequence, processors_num=None, use_shared_memory=False):
 
+def transform_images(image_sequence, processors_num=None, use_shared_memory=False, decode_gvf_field=False,
+                     gvf_levels=1, path=None):
+    """
+    Transform images of the preprocessed sequence for tracking. If `path` (folder of the preprocessed files) is
+    given, dilated binaries and distance maps of branching points are kept in <path>/tracker_cache/derived
+    keyed by the content of binaries.tif and branching.tif and computed only when they change.
+    """
     ticker = Ticker()
 
     image_sequence["enhanced"] = ('i', rescale_intensity(image_sequence["enhanced"][1].astype(np.double)))
@@ -66,10 +99,32 @@ def transform_images(image_sequence, processors_num=None, use_shared_memory=Fals
 
     ticker.tick("\nTransforming images...")
     transform = ParallelMap(processors_num)
-    image_sequence["binaries"] = ('i', transform.map(transform_binary, image_sequence["binaries"][1]))
-    image_sequence["branching"] = ('i', transform.map(transform_distance, image_sequence["branching"][1]))
+    for key, function in [("binaries", transform_binary), ("branching", transform_distance)]:
+        if key not in image_sequence:
+            continue
+        images = image_sequence[key][1]
+        if path is None:
+            image_sequence[key] = ('i', transform.map(function, images))
+        else:
+            image_sequence[key] = ('i', cached_layer(os.path.join(path, 'tracker_cache', 'derived'), key,
+                                                     os.path.join(path, key + '.tif'),
+                                                     lambda: transform.map(function, images)))
     ticker.tock(" Finished.")
 
+    if gvf_levels > 1:
+        ticker.tick("\nComputing pyramid of gradient vector flow...")
+        pyramid = gvf_pyramid(image_sequence["gvf_magnitude"][1], image_sequence["gvf_angle"][1], gvf_levels)
+        for key, layer in pyramid.items():
+            image_sequence[key] = ('i', layer)
+        ticker.tock(" Finished.")
+
+    if decode_gvf_field:
+        ticker.tick("\nDecoding gradient vector flow...")
+        gvf_x, gvf_y = decode_gvf(image_sequence.pop("gvf_magnitude")[1], image_sequence.pop("gvf_angle")[1])
+        image_sequence["gvf_x"] = ('i', gvf_x)
+        image_sequence["gvf_y"] = ('i', gvf_y)
+        ticker.tock(" Finished.")
+
     if use_shared_memory:
         ticker.tick("\nMapping to shared memory...")
         image_sequence_shared = to_shared_memory(image_sequence)
@@ -102,6 +157,28 @@ def upload_initialization(path):
     return result
 
 
+def upload_final_states(path):
+    """
+    Read final states of the filaments tracked by a previous run in the folder `path` (from tracks.npz
+    or from <filament>_state.npz files), tracking can be continued from them on appended frames
+    """
+    fields = ['last_frame', 'last_contour', 'last_ends', 'ends_initialized']
+    results = dict()
+    store_path = os.path.join(path, 'tracks.npz')
+    if os.path.exists(store_path):
+        with np.load(store_path) as store:
+            for key in store.files:
+                name, _, field = key.rpartition('/')
+                if field in fields:
+                    results.setdefault(name, dict())[field] = store[key]
+    else:
+        for filename in os.listdir(path):
+            if filename.endswith('_state.npz'):
+                with np.load(os.path.join(path, filename)) as state:
+                    results[filename[:-len('_state.npz')]] = {field: state[field] for field in state.files}
+    return final_states(results)
+
+
 def main():
 
     # Read configuration
@@ -116,47 +193,102 @@ def main():
     # Use multiprocessing
     is_parallel = tracker_config['Parallel Computing']['Enabled_b']
 
+    # Decode gradient vector flow once instead of decoding it at every sampled point
+    decode_gvf_field = tracker_config.get('Evolution', 'GVF', 'encoded').strip().lower() == 'decoded'
+
+    # Memory-map cached preprocessed data instead of copying it to shared memory
+    use_cache = tracker_config.get('Input', 'Cache_b', False)
+
+    # Levels of the GVF pyramid for the coarse-to-fine evolution
+    gvf_levels = tracker_config.get('Evolution', 'Resolution_Levels_i', 1)
+
+    # Distance map of branching points is read only if it is weighted in endpoint tracking
+    branch_distance = tracker_config.get('Evolution', 'Branch_Cost_f', 0.0) != 0.0
+
     # Read preprocessed data
     image_sequence = upload_sequence(os.path.join('..', '..', 'output', 'preprocessing', output_folder),
-                                     use_shared_memory=is_parallel)
+                                     use_shared_memory=is_parallel, decode_gvf_field=decode_gvf_field,
+                                     use_cache=use_cache, gvf_levels=gvf_levels, branch_distance=branch_distance)
 
+    sequence_output = os.path.join("../../output/tracking", output_folder)
     try:
-        init_path = tracker_config['Initialization']['Path']
-        if init_path == '':
-            raise Exception("Empty Path")
+        os.mkdir(sequence_output)
     except:
-        sequence_path = os.path.join('../../output/generator', output_folder)
+        pass
+
+    # Continue tracking of a previous run (its folder name or 'latest') on the frames appended to the sequence
+    continue_run = tracker_config.get('Initialization', 'Continue', '').strip()
+    if continue_run.lower() == 'latest':
+        continue_run = get_latest_folder(sequence_output)
+
+    if continue_run != '':
+        init_path = os.path.join(sequence_output, continue_run)
+        colors_path = os.path.join(init_path, 'colors.csv')
+    else:
+        colors_path = None
         try:
-            input_folder = get_latest_folder(sequence_path)
-            init_path = os.path.join(sequence_path, input_folder, "filaments.zip")
+            init_path = tracker_config['Initialization']['Path']
+            if init_path == '':
+                raise Exception("Empty Path")
         except:
-            return
+            sequence_path = os.path.join('../../output/generator', output_folder)
+            try:
+                input_folder = get_latest_folder(sequence_path)
+                init_path = os.path.join(sequence_path, input_folder, "filaments.zip")
+                colors_path = os.path.join(sequence_path, input_folder, 'colors.csv')
+            except:
+                return
 
     ticker = Ticker()
-    ticker.tick("\nReading initial filaments...")
-    initialization = upload_initialization(init_path)
+    if continue_run != '':
+        ticker.tick("\nReading final states of run {0}...".format(continue_run))
+        initialization = upload_final_states(init_path)
+    else:
+        ticker.tick("\nReading initial filaments...")
+        initialization = upload_initialization(init_path)
     ticker.tock(" Finished.")
 
-    sequence_output = os.path.join("../../output/tracking", output_folder)
-    try:
-        os.mkdir(sequence_output)
-    except:
-        pass
+    # Resume an interrupted run (its folder name or 'latest') or start a new one
+    resume = tracker_config.get('Output', 'Resume', '').strip()
+    checkpoint = tracker_config.get('Output', 'Checkpoint_b', False) or resume != ''
+    if resume.lower() == 'latest':
+        try:
+            resume = get_latest_folder(sequence_output)
+        except IndexError:
+            print "\nCannot resume the latest run: there are no runs in {0}".format(sequence_output)
+            return
 
-    run_output = os.path.join(sequence_output, datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
-    try:
-        os.mkdir(run_output)
-    except:
-        pass
+    if resume != '':
+        run_output = os.path.join(sequence_output, resume)
+        if not os.path.isdir(run_output):
+            print "\nCannot resume run {0}: folder {1} does not exist".format(resume, run_output)
+            return
+        # Skip filaments that are already tracked
+        completed = completed_filaments(run_output)
+        initialization = {name: polyline for name, polyline in initialization.items() if name not in completed}
+        print "\nResuming run {0}: {1} filaments completed, {2} left.".format(resume, len(completed),
+                                                                            len(initialization))
+        append_manifest(run_output, {'resumed': str(datetime.now()), 'filaments': sorted(initialization.keys())})
+        if len(initialization) == 0:
+            return
+    else:
+        run_output = os.path.join(sequence_output, datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
+        try:
+            os.mkdir(run_output)
+        except:
+            pass
+        if checkpoint:
+            append_manifest(run_output, {'started': str(datetime.now()), 'initialization': init_path,
+                                         'filaments': sorted(initialization.keys())})
 
     try:
-        shutil.copy2(os.path.join(sequence_path, input_folder, 'colors.csv'), run_output)
+        shutil.copy2(colors_path, run_output)
     except:
         pass
 
     # Track all filaments
     ticker.tick("\nStarting tracking...")
-    track_all(initialization, image_sequence, tracker_config, run_output)
+    track_all(initialization, image_sequence, tracker_config, run_output, checkpoint)
     ticker.tock(" Tracking completed!")
 
 
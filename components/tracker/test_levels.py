@@ -0,0 +1,111 @@
+#
+# Copyright (C) Software Competence Center Hagenberg GmbH (SCCH)
+# All rights reserved.
+#
+# This document contains proprietary information belonging to SCCH.
+# Passing on and copying of this document, use and communication of its
+# contents is not permitted without prior written authorization.
+#
+
+import sys
+sys.path.append("../common")
+
+import numpy as np
+from skimage.draw import line
+from skimage.filters import gaussian
+from skimage.transform import rescale
+from skimage.exposure import rescale_intensity
+
+from coder import encode_vector_field
+from image import gvf_pyramid
+from utils import to_image_sequence
+from modules.snakes import compute_gvf
+from modules.track import Tracker, TrackerParams
+from modules.batch import BatchTracker
+from modules.parametrize import uniform_contour_reparametrization as reparametrize
+
+
+def synthetic_sequence(frame_n=3, size=96, levels=2):
+    """
+    Sequence of two curved filaments moving by a pixel per frame and their initial polylines
+    """
+    t = np.linspace(0.0, 1.0, 40)
+    curves = [np.dstack([20.0 + 30.0 * k + 8.0 * np.sin(3.0 * t + k), 15.0 + 60.0 * t])[0] for k in xrange(2)]
+
+    enhanced, skeletons, coords, gvf_m, gvf_a = [], [], [], [], []
+    for image_i in xrange(frame_n):
+        image = np.zeros((size, size))
+        ends = []
+        for curve in curves:
+            points = curve + np.array([0.8, 0.5]) * image_i
+            for p, q in zip(points[:-1], points[1:]):
+                rr, cc = line(int(p[1]), int(p[0]), int(q[1]), int(q[0]))
+                image[rr, cc] = 1.0
+            ends.extend([points[0], points[-1]])
+        smooth = rescale_intensity(gaussian(image, 1.2))
+        upscaled = rescale_intensity(rescale(smooth, 2.0, order=1, mode='constant', multichannel=False,
+                                             anti_aliasing=False))
+        magnitude, angle = encode_vector_field(compute_gvf(1.0 - upscaled, mu=0.05, max_iter=10))
+        enhanced.append(smooth)
+        skeletons.append(image.astype(np.uint8))
+        coords.append(np.array(ends))
+        gvf_m.append(magnitude)
+        gvf_a.append(angle)
+
+    sequence = {
+        "enhanced": ('i', np.array(enhanced)),
+        "skeletons": ('i', np.array(skeletons)),
+        "binaries": ('i', (np.array(enhanced) > 0.2).astype(np.uint8)),
+        "branching_coords": ('p', coords),
+        "gvf_magnitude": ('i', np.array(gvf_m)),
+        "gvf_angle": ('i', np.array(gvf_a))
+    }
+    for key, layer in gvf_pyramid(sequence["gvf_magnitude"][1], sequence["gvf_angle"][1], levels).items():
+        sequence[key] = ('i', layer)
+
+    return to_image_sequence(sequence), [curve[4:-4] for curve in curves]
+
+
+def tracker_params(trajectory_mode, levels):
+    params = TrackerParams()
+    params.kernel_size = 11
+    params.kernel_sigma = 2.5
+    params.alpha = 1.0
+    params.beta = 1.0
+    params.max_iter_n = 300
+    params.dt = 0.01
+    params.min_shift = 1.0e-7
+    params.trajectory_mode = trajectory_mode
+    params.history_size = 0
+    params.store_potentials = False
+    params.potential_window = 15
+    params.warm_start = 'previous'
+    params.flow_max_shift = 10.0
+    params.compare_warm_start = False
+    params.resolution_levels = levels
+    params.coarse_iter_n = 200
+    params.coarse_min_shift = 1.0e-3
+    params.branch_cost = 0.0
+    return params
+
+
+sequence, polylines = synthetic_sequence()
+snakes = [np.dstack(reparametrize(polyline[:, 0], polyline[:, 1], 1.0, 'linear')[:2])[0] for polyline in polylines]
+
+# Full trajectory with coarse levels: the fine level has less than the maximum iterations
+for name, track in [("Tracker", lambda params: [Tracker(sequence, params).track(snake, "") for snake in snakes]),
+                    ("BatchTracker", lambda params: BatchTracker(sequence, params).track_batch(snakes, ""))]:
+    compact = track(tracker_params('compact', 2))
+    full = track(tracker_params('full', 2))
+
+    for compact_result, full_result in zip(compact, full):
+        trajectory = full_result["snake_trajectory"]
+        contours = full_result["snake_contours"]
+        assert trajectory.shape[1] == 300 + 1
+        assert np.array_equal(trajectory[:, -1], contours)
+        assert np.array_equal(contours, compact_result["snake_contours"])
+
+    print "{0}: full trajectory with 2 resolution levels, iterations: {1}".format(
+        name, [result["snake_iterations"].tolist() for result in full])
+
+print "OK"
@@ -10,6 +10,11 @@
 #
 
 
+import os
+import glob
+import json
+import mmap
+import hashlib
 import numpy as np
 import multiprocessing as mp
 
@@ -27,11 +32,22 @@ def make_shared(npy_array):
     return shared_memory
 
 
+def is_mapped(npy_array):
+    """
+    Check if `npy_array` is a whole .npy file mapped to memory (see `load_cache`)
+    """
+    return isinstance(npy_array, np.memmap) and isinstance(npy_array.base, mmap.mmap) and \
+        npy_array.filename is not None
+
+
 def to_shared_memory(data_dictionary):
     shared_dictionary = dict()
     for key, data in data_dictionary.items():
         meta, arr = data
-        if meta == 'i':
+        if meta == 'i' and is_mapped(arr):
+            # memory-mapped files are shared by their names (every process maps the same file)
+            shared_dictionary[key] = ('m', arr.filename, arr.shape, str(arr.dtype))
+        elif meta == 'i':
             shared_dictionary[key] = (meta, make_shared(arr), arr.shape, str(arr.dtype))
         elif meta == 'p':
             data_sizes = np.asarray([len(a) for a in arr])
@@ -60,6 +76,9 @@ def unpack_values(package):
     # Make a dictionary
     data = dict()
     for k, m, a, s, t in zip(keys, meta, arrays, shapes, types):
+        if m == 'm':
+            data[k] = ('i', np.load(a, mmap_mode='r'))
+            continue
         buffer_ = np.frombuffer(a, t)
         if m == 'i':
             data[k] = (m, buffer_.reshape(s))
@@ -75,6 +94,136 @@ def unpack_values(package):
     return data
 
 
+def file_stamps(paths):
+    """
+    Sizes and modification times of files `paths` (None for missing files)
+    """
+    stamps = dict()
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stamps[os.path.basename(path)] = [stat.st_size, stat.st_mtime]
+        else:
+            stamps[os.path.basename(path)] = None
+    return stamps
+
+
+def save_cache(folder, data_dictionary, sources):
+    """
+    Save layers of `data_dictionary` as uncompressed .npy files to `folder` together with the stamps of
+    `sources` (files the layers are computed from). Point layers are stored as stacked points and sizes.
+    """
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    for key, (meta, arr) in data_dictionary.items():
+        if meta == 'i':
+            np.save(os.path.join(folder, key + '.npy'), np.ascontiguousarray(arr))
+        elif meta == 'p':
+            np.save(os.path.join(folder, key + '.points.npy'), np.vstack(arr))
+            np.save(os.path.join(folder, key + '.sizes.npy'), np.asarray([len(a) for a in arr], dtype=np.int64))
+    # stamps are written last, an interrupted cache is never valid
+    with open(os.path.join(folder, 'sources.json'), 'w') as fout:
+        json.dump({'sources': file_stamps(sources), 'layers': sorted(data_dictionary.keys())}, fout)
+
+
+def load_cache(folder, sources):
+    """
+    Open layers saved by `save_cache` to `folder`, image layers are memory-mapped read-only (zero-copy, the pages
+    are shared by all processes through the page cache). Returns None if the cache is missing or `sources` changed.
+    """
+    try:
+        with open(os.path.join(folder, 'sources.json')) as fin:
+            description = json.load(fin)
+    except (IOError, ValueError):
+        return None
+    if description['sources'] != json.loads(json.dumps(file_stamps(sources))):
+        return None
+    data = dict()
+    for key in description['layers']:
+        key = str(key)
+        if os.path.exists(os.path.join(folder, key + '.npy')):
+            data[key] = ('i', np.load(os.path.join(folder, key + '.npy'), mmap_mode='r'))
+        else:
+            points = np.load(os.path.join(folder, key + '.points.npy'))
+            sizes = np.load(os.path.join(folder, key + '.sizes.npy'))
+            data[key] = ('p', np.split(points, np.cumsum(sizes)[:-1]))
+    return data
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """
+    SHA-1 of the content of the file `path`
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def cached_layer(folder, name, source, compute):
+    """
+    Image layer `name` computed by `compute()` from the file `source`. The layer is kept in `folder` as
+    <name>_<SHA-1 of source>.npy and computed again only when the content of `source` changes (layers of the
+    previous content are removed). Returns the layer memory-mapped read-only.
+    """
+    path = os.path.join(folder, '{0}_{1}.npy'.format(name, file_hash(source)))
+    if not os.path.exists(path):
+        layer = compute()
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        for outdated in glob.glob(os.path.join(folder, '{0}_*.npy'.format(name))):
+            os.remove(outdated)
+        # Save to a temporary file first, a layer with the hash in its name is always complete
+        with open(path + '.tmp', 'wb') as fout:
+            np.save(fout, np.ascontiguousarray(layer))
+        os.rename(path + '.tmp', path)
+    return np.load(path, mmap_mode='r')
+
+
+def append_manifest(folder, record):
+    """
+    Append `record` (a JSON serializable dictionary) as a line to the run manifest of `folder`,
+    the line is flushed to disk immediately
+    """
+    with open(os.path.join(folder, 'manifest.jsonl'), 'a+') as fout:
+        # Terminate the last line if it is incomplete (interrupted run), so that the record is not glued to it
+        fout.seek(0, os.SEEK_END)
+        prefix = ''
+        if fout.tell() > 0:
+            fout.seek(-1, os.SEEK_END)
+            if fout.read(1) != '\n':
+                prefix = '\n'
+            fout.seek(0, os.SEEK_END)
+        fout.write(prefix + json.dumps(record) + '\n')
+        fout.flush()
+        os.fsync(fout.fileno())
+
+
+def read_manifest(folder):
+    """
+    Read records of the run manifest of `folder`, incomplete lines (interrupted runs) are ignored
+    """
+    records = []
+    try:
+        with open(os.path.join(folder, 'manifest.jsonl')) as fin:
+            for line in fin:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass
+    except IOError:
+        pass
+    return records
+
+
+def completed_filaments(folder):
+    """
+    Names of filaments that are already tracked and saved in the run folder
+    """
+    return set(str(record['filament']) for record in read_manifest(folder) if 'filament' in record)
+
+
 def to_image_sequence(dictionary):
     result = ImageSequence()
     for key, attrib in dictionary.items():